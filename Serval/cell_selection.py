@@ -0,0 +1,184 @@
+import numpy
+
+
+def mask_runs(mask, row, col):
+    """
+    Return row-wise runs of True cells of the mask, with upper left cell at (row, col), as arrays of runs global rows,
+    first columns and end (exclusive) columns, in row-major order.
+    """
+    padded = numpy.zeros((mask.shape[0], mask.shape[1] + 2), dtype=numpy.int8)
+    padded[:, 1:-1] = mask
+    edges = numpy.diff(padded, axis=1)
+    run_rows, starts = numpy.nonzero(edges == 1)
+    _, ends = numpy.nonzero(edges == -1)
+    return run_rows + row, starts + col, ends + col
+
+
+class CellSelection(object):
+    """
+    Compact selection of raster cells, stored as row-wise runs (spans) of selected cells with global row, first column
+    and end (exclusive) column. The size of the selection and the cost of its processing scale with nr of runs, not
+    with the area of the selection bounding block, e.g. for thin diagonal line selections across large rasters.
+    Cell indices, masks of blocks and cell centers are computed on demand.
+    The selection is immutable, so it can be shared, e.g. by selection cache and background tasks.
+    """
+
+    CHUNK_CELLS = 2 ** 24  # max nr of cells unpacked at once
+    CHUNK_RUNS = 2 ** 20  # max nr of brush runs stamped at once
+
+    def __init__(self, run_rows, run_starts, run_ends):
+        """Runs must be sorted by rows and starts, not overlapping and not empty - use from_runs otherwise."""
+        self.run_rows = run_rows
+        self.run_starts = run_starts
+        self.run_ends = run_ends
+        self.row = int(run_rows[0])
+        self.rows = int(run_rows[-1]) - self.row + 1
+        self.col = int(run_starts.min())
+        self.cols = int(run_ends.max()) - self.col
+        self.count = int((run_ends - run_starts).sum())
+        # indices of the first run of each row of the block (and the end)
+        self.row_offsets = numpy.searchsorted(run_rows, numpy.arange(self.row, self.row + self.rows + 1))
+
+    @classmethod
+    def from_runs(cls, run_rows, run_starts, run_ends):
+        """Return selection of the runs in any order, merging overlapping ones, or None if no cell is selected."""
+        run_rows, run_starts, run_ends = (numpy.asarray(a, dtype=numpy.int64) for a in (run_rows, run_starts, run_ends))
+        valid = run_ends > run_starts
+        run_rows, run_starts, run_ends = run_rows[valid], run_starts[valid], run_ends[valid]
+        if run_rows.size == 0:
+            return None
+        order = numpy.lexsort((run_starts, run_rows))
+        run_rows, run_starts, run_ends = run_rows[order], run_starts[order], run_ends[order]
+        # positions of runs along all the rows placed one after another, so that runs of different rows never touch
+        width = int(run_ends.max()) - int(run_starts.min()) + 2
+        offsets = (run_rows - run_rows[0]) * width - int(run_starts.min())
+        pos_starts, pos_ends = run_starts + offsets, run_ends + offsets
+        reached = numpy.maximum.accumulate(pos_ends)
+        first = numpy.ones(run_rows.size, dtype=bool)
+        first[1:] = pos_starts[1:] > reached[:-1]
+        firsts = numpy.flatnonzero(first)
+        merged_ends = numpy.maximum.reduceat(pos_ends, firsts) - offsets[firsts]
+        return cls(run_rows[firsts], run_starts[firsts], merged_ends)
+
+    @classmethod
+    def from_mask(cls, mask, row, col):
+        """Return selection of True cells of the mask with upper left cell at (row, col), or None if there are none."""
+        return cls.from_runs(*mask_runs(mask, row, col))
+
+    @classmethod
+    def from_stroke(cls, rows, cols, brush, raster_rows, raster_cols):
+        """
+        Return selection of cells covered by the brush (see utils.brush_rows) placed at each of the stroke cells, given
+        as arrays of their rows and columns, clipped to the raster of raster_rows x raster_cols cells, or None.
+        Brush rows are stamped onto row-wise runs of the stroke cells, so the cost scales with nr of the runs times
+        nr of brush rows, not with the brush area.
+        """
+        centers = cls.from_runs(rows, cols, cols + 1)
+        if centers is None:
+            return None
+        d_rows, half_widths = brush
+        inside = (d_rows >= -centers.row_max) & (d_rows < raster_rows - centers.row)
+        d_rows, half_widths = d_rows[inside], half_widths[inside]
+        step = max(cls.CHUNK_RUNS // max(d_rows.size, 1), 1)
+        selection = None
+        for first in range(0, centers.run_rows.size, step):
+            runs = slice(first, first + step)
+            run_rows = (centers.run_rows[runs, None] + d_rows[None, :]).ravel()
+            run_starts = numpy.maximum(centers.run_starts[runs, None] - half_widths[None, :], 0).ravel()
+            run_ends = numpy.minimum(centers.run_ends[runs, None] + half_widths[None, :], raster_cols).ravel()
+            valid = (run_rows >= 0) & (run_rows < raster_rows)
+            stamped = cls.from_runs(run_rows[valid], run_starts[valid], run_ends[valid])
+            if stamped is not None:
+                selection = stamped.union(selection)
+        return selection
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def row_max(self):
+        return self.row + self.rows - 1
+
+    @property
+    def col_max(self):
+        return self.col + self.cols - 1
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.run_rows, self.run_starts, self.run_ends, self.row_offsets))
+
+    def row_runs(self, row, rows):
+        """Return slice of runs of rows in range row, row + rows (global indices)."""
+        first = min(max(row - self.row, 0), self.rows)
+        last = min(max(row + rows - self.row, 0), self.rows)
+        return slice(self.row_offsets[first], self.row_offsets[last])
+
+    def union(self, other):
+        """Return selection of cells selected in this or the other selection."""
+        if other is None:
+            return self
+        return CellSelection.from_runs(*(numpy.concatenate(arrays) for arrays in zip(self.runs(), other.runs())))
+
+    def runs(self):
+        return self.run_rows, self.run_starts, self.run_ends
+
+    def without_window(self, row_min, row_max, col_min, col_max):
+        """Return selection without cells in the window (global indices, inclusive), or None if nothing remains."""
+        in_rows = (self.run_rows >= row_min) & (self.run_rows <= row_max)
+        hit = in_rows & (self.run_starts <= col_max) & (self.run_ends > col_min)
+        # runs crossing the window are split to the parts left and right of it
+        left = hit & (self.run_starts < col_min)
+        right = hit & (self.run_ends > col_max + 1)
+        run_rows = numpy.concatenate([self.run_rows[~hit], self.run_rows[left], self.run_rows[right]])
+        run_starts = numpy.concatenate([self.run_starts[~hit], self.run_starts[left],
+                                        numpy.full(numpy.count_nonzero(right), col_max + 1)])
+        run_ends = numpy.concatenate([self.run_ends[~hit], numpy.full(numpy.count_nonzero(left), col_min),
+                                      self.run_ends[right]])
+        return CellSelection.from_runs(run_rows, run_starts, run_ends)
+
+    def window_mask(self, row, col, rows, cols):
+        """Return boolean mask of the window of rows x cols cells with upper left cell at (row, col) (global)."""
+        runs = self.row_runs(row, rows)
+        starts = numpy.clip(self.run_starts[runs] - col, 0, cols)
+        ends = numpy.clip(self.run_ends[runs] - col, 0, cols)
+        inside = ends > starts
+        run_rows = self.run_rows[runs][inside] - row
+        edges = numpy.zeros((rows, cols + 1), dtype=numpy.int32)
+        numpy.add.at(edges, (run_rows, starts[inside]), 1)
+        numpy.add.at(edges, (run_rows, ends[inside]), -1)
+        return numpy.cumsum(edges, axis=1)[:, :cols] > 0
+
+    def tiles(self, size):
+        """
+        Return list of (row, col) global indices of upper left cells of the block tiles of size x size cells, which
+        contain any selected cell. The tiles are aligned to the block upper left cell.
+        """
+        tile_rows = (self.run_rows - self.row) // size
+        first_cols = (self.run_starts - self.col) // size
+        counts = (self.run_ends - 1 - self.col) // size - first_cols + 1
+        local = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        keys = numpy.unique(numpy.stack([numpy.repeat(tile_rows, counts), numpy.repeat(first_cols, counts) + local]),
+                            axis=1)
+        return [(self.row + tile_row * size, self.col + tile_col * size) for tile_row, tile_col in keys.T.tolist()]
+
+    def chunks(self):
+        """Yield slices of runs, each with at most CHUNK_CELLS cells (but at least one run)."""
+        cells = numpy.cumsum(self.run_ends - self.run_starts)
+        start = 0
+        while start < self.run_rows.size:
+            done = cells[start - 1] if start else 0
+            end = max(int(numpy.searchsorted(cells, done + self.CHUNK_CELLS, side="right")), start + 1)
+            yield slice(start, end)
+            start = end
+
+    def indices(self, runs=slice(None)):
+        """Return arrays of global rows and columns of selected cells (in the runs slice), sorted by rows and cols."""
+        lengths = self.run_ends[runs] - self.run_starts[runs]
+        local = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        return numpy.repeat(self.run_rows[runs], lengths), numpy.repeat(self.run_starts[runs], lengths) + local
+
+    def iter_cells(self):
+        """Yield (row, col) global indices of selected cells, expanding the runs by chunks."""
+        for runs in self.chunks():
+            rows, cols = self.indices(runs)
+            yield from zip(rows.tolist(), cols.tolist())
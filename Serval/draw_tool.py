@@ -0,0 +1,95 @@
+from qgis.PyQt.QtCore import Qt, pyqtSignal
+from qgis.PyQt.QtGui import QPixmap, QCursor, QColor
+from qgis.core import QgsGeometry, QgsWkbTypes
+from qgis.gui import QgsMapTool, QgsRubberBand
+
+from .utils import icon_path
+
+
+class RasterDrawMapTool(QgsMapTool):
+    """
+    Raster drawing tool - a click draws at the clicked point, dragging with left button pressed draws a freehand
+    stroke. Stroke segments are emitted as their start and end points in map canvas CRS (the same point for a click).
+    """
+
+    stroke_started = pyqtSignal()
+    segment_drawn = pyqtSignal(object, object)
+    stroke_finished = pyqtSignal()
+
+    def __init__(self, canvas, cursor_icon='draw_tool.svg'):
+        super(RasterDrawMapTool, self).__init__(canvas)
+        self.cursor_icon = cursor_icon
+        self.last_point = None  # the last point of the stroke being drawn
+        self.setCursor(QCursor(QPixmap(icon_path(self.cursor_icon)), hotX=2, hotY=22))
+
+    def activate(self):
+        self.setCursor(QCursor(QPixmap(icon_path(self.cursor_icon)), hotX=2, hotY=22))
+        QgsMapTool.activate(self)
+
+    def deactivate(self):
+        self.finish_stroke()
+        QgsMapTool.deactivate(self)
+
+    def canvasPressEvent(self, e):
+        if e.button() != Qt.LeftButton:
+            return
+        self.last_point = e.mapPoint()
+        self.stroke_started.emit()
+        self.segment_drawn.emit(self.last_point, self.last_point)
+
+    def canvasMoveEvent(self, e):
+        if self.last_point is None:
+            return
+        point = e.mapPoint()
+        self.segment_drawn.emit(self.last_point, point)
+        self.last_point = point
+
+    def canvasReleaseEvent(self, e):
+        if e.button() == Qt.LeftButton:
+            self.finish_stroke()
+
+    def finish_stroke(self):
+        if self.last_point is None:
+            return
+        self.last_point = None
+        self.stroke_finished.emit()
+
+
+class RasterBrushMapTool(RasterDrawMapTool):
+    """
+    Raster painting tool - the same as the drawing tool, but cells are painted with a round brush. The brush outline
+    follows the cursor, its radius is set in map canvas units.
+    """
+
+    OUTLINE_SEGMENTS = 16  # nr of segments per quarter of the brush outline circle
+
+    def __init__(self, canvas):
+        super(RasterBrushMapTool, self).__init__(canvas, cursor_icon='brush.svg')
+        self.radius = 0.
+        self.outline = QgsRubberBand(canvas, QgsWkbTypes.PolygonGeometry)
+        self.outline.setColor(QColor(Qt.yellow))
+        self.outline.setFillColor(QColor(0, 0, 0, 0))
+        self.outline.setWidth(1)
+
+    def activate(self):
+        RasterDrawMapTool.activate(self)
+        self.setCursor(QCursor(Qt.CrossCursor))
+
+    def deactivate(self):
+        self.outline.reset(QgsWkbTypes.PolygonGeometry)
+        RasterDrawMapTool.deactivate(self)
+
+    def set_radius(self, radius):
+        self.radius = radius
+
+    def canvasMoveEvent(self, e):
+        self.update_outline(e.mapPoint())
+        RasterDrawMapTool.canvasMoveEvent(self, e)
+
+    def update_outline(self, point):
+        """Show the brush outline around the point."""
+        if self.radius <= 0:
+            self.outline.reset(QgsWkbTypes.PolygonGeometry)
+            return
+        circle = QgsGeometry.fromPointXY(point).buffer(self.radius, self.OUTLINE_SEGMENTS)
+        self.outline.setToGeometry(circle, None)
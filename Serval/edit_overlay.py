@@ -0,0 +1,138 @@
+import threading
+
+import numpy
+from qgis.core import Qgis, QgsRasterInterface
+
+from .utils import block_to_array
+
+
+class EditOverlay(object):
+    """
+    In-memory sparse overlay of raster tiles modified in an edit session.
+    A tile of tile_size cells is stored whole when it is first written to, all stored tiles are dirty until committed.
+    """
+
+    def __init__(self, tile_size=256):
+        self.tile_size = tile_size
+        self.tiles = dict()  # {(band_nr, tile_row, tile_col): array}
+        self.lock = threading.RLock()
+
+    def is_empty(self):
+        return not self.tiles
+
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def tile_keys(self, band_nr, row, col, rows, cols):
+        """Return keys of band tiles overlapping block of rows x cols cells with upper left cell at (row, col)."""
+        size = self.tile_size
+        return [(band_nr, tile_row, tile_col)
+                for tile_row in range(row // size * size, row + rows, size)
+                for tile_col in range(col // size * size, col + cols, size)]
+
+    @staticmethod
+    def intersection(key, tile_shape, row, col, rows, cols):
+        """Return windows of the tile and the block (with upper left cell at row, col) where they overlap, or None."""
+        _, tile_row, tile_col = key
+        row_min, row_max = max(row, tile_row), min(row + rows, tile_row + tile_shape[0])
+        col_min, col_max = max(col, tile_col), min(col + cols, tile_col + tile_shape[1])
+        if row_min >= row_max or col_min >= col_max:
+            return None
+        tile_window = (slice(row_min - tile_row, row_max - tile_row), slice(col_min - tile_col, col_max - tile_col))
+        block_window = (slice(row_min - row, row_max - row), slice(col_min - col, col_max - col))
+        return tile_window, block_window
+
+    def patch(self, band_nr, array, row, col):
+        """Overwrite the band array cells (with upper left cell at row, col) with overlay values. Return True if any."""
+        patched = False
+        with self.lock:
+            for key in self.tile_keys(band_nr, row, col, *array.shape):
+                tile = self.tiles.get(key)
+                if tile is None:
+                    continue
+                windows = self.intersection(key, tile.shape, row, col, *array.shape)
+                if windows is None:
+                    continue
+                array[windows[1]] = tile[windows[0]]
+                patched = True
+        return patched
+
+    def write(self, band_nr, array, row, col, read_tile):
+        """
+        Store the band array cells (with upper left cell at row, col) in overlay tiles.
+        Tiles not stored yet are read first with read_tile(band_nr, tile_row, tile_col).
+        """
+        with self.lock:
+            for key in self.tile_keys(band_nr, row, col, *array.shape):
+                tile = self.tiles.get(key)
+                if tile is None:
+                    tile = self.tiles[key] = read_tile(*key)
+                windows = self.intersection(key, tile.shape, row, col, *array.shape)
+                if windows is not None:
+                    tile[windows[0]] = array[windows[1]]
+
+    def sample(self, band_nr, rows, cols, array):
+        """
+        Overwrite cells of rendered band array with overlay values of raster cells at rows (for each array row) and
+        cols (for each array column). Return True if any cell was overwritten.
+        """
+        patched = False
+        with self.lock:
+            for (tile_band, tile_row, tile_col), tile in self.tiles.items():
+                if tile_band != band_nr:
+                    continue
+                sel_rows = numpy.flatnonzero((rows >= tile_row) & (rows < tile_row + tile.shape[0]))
+                sel_cols = numpy.flatnonzero((cols >= tile_col) & (cols < tile_col + tile.shape[1]))
+                if sel_rows.size == 0 or sel_cols.size == 0:
+                    continue
+                array[numpy.ix_(sel_rows, sel_cols)] = tile[numpy.ix_(rows[sel_rows] - tile_row,
+                                                                      cols[sel_cols] - tile_col)]
+                patched = True
+        return patched
+
+    def dirty_tiles(self):
+        """Return dict {(tile_row, tile_col): {band_nr: array}} of stored tiles."""
+        with self.lock:
+            tiles = dict()
+            for (band_nr, tile_row, tile_col), tile in self.tiles.items():
+                tiles.setdefault((tile_row, tile_col), dict())[band_nr] = tile
+            return tiles
+
+    def clear(self):
+        with self.lock:
+            self.tiles = dict()
+
+
+class OverlayRasterInterface(QgsRasterInterface):
+    """
+    Raster pipe interface, inserted right after the data provider, rendering raster blocks with cells modified in edit
+    session overlay. Geo is (origin_x, origin_y, pixel_size_x, pixel_size_y) of the raster.
+    """
+
+    def __init__(self, overlay, geo, input=None):
+        super(OverlayRasterInterface, self).__init__(input)
+        self.overlay = overlay
+        self.geo = geo
+
+    def clone(self):
+        return OverlayRasterInterface(self.overlay, self.geo)
+
+    def bandCount(self):
+        return self.input().bandCount() if self.input() else 0
+
+    def dataType(self, band_nr):
+        return self.input().dataType(band_nr) if self.input() else Qgis.UnknownDataType
+
+    def block(self, band_nr, extent, width, height, feedback=None):
+        block = self.input().block(band_nr, extent, width, height, feedback)
+        if self.overlay.is_empty() or not block.isValid():
+            return block
+        origin_x, origin_y, pixel_size_x, pixel_size_y = self.geo
+        xs = extent.xMinimum() + (numpy.arange(width) + 0.5) * extent.width() / width
+        ys = extent.yMaximum() - (numpy.arange(height) + 0.5) * extent.height() / height
+        cols = numpy.floor((xs - origin_x) / pixel_size_x).astype(numpy.int64)
+        rows = numpy.floor((origin_y - ys) / pixel_size_y).astype(numpy.int64)
+        array = block_to_array(block)
+        if self.overlay.sample(band_nr, rows, cols, array):
+            block.setData(array.tobytes())
+        return block
@@ -0,0 +1,70 @@
+from qgis.core import QgsTask
+
+
+class PhaseFeedback(object):
+    """Feedback for a phase of a task - maps the phase progress (0-100) into the task progress range."""
+
+    def __init__(self, task, start, end):
+        self.task = task
+        self.start = start
+        self.end = end
+
+    def isCanceled(self):
+        return self.task.isCanceled()
+
+    def setProgress(self, progress):
+        self.task.setProgress(self.start + (self.end - self.start) * progress / 100.)
+
+
+class RasterEditTask(QgsTask):
+    """
+    Background task for a raster edit: selection of cells (unless current selection is used), evaluation of
+    expression values (if an evaluator is given) and writing modified blocks. The task can be canceled - tiles already
+    written are rolled back then, as well as when writing fails.
+    When the task is finished, on_finished(task, result) is called in the main thread.
+    """
+
+    def __init__(self, description, handler, geometries, all_touched, on_finished,
+                 const_values=None, raster_filter=None, evaluator=None, threads=1, init_worker=None):
+        super(RasterEditTask, self).__init__(description, QgsTask.CanCancel)
+        self.handler = handler
+        self.layer_id = handler.layer.id()
+        self.geometries = geometries  # valid selecting geometries in raster CRS, None to use current handler selection
+        self.all_touched = all_touched
+        self.on_finished = on_finished
+        self.const_values = const_values
+        self.raster_filter = raster_filter
+        self.evaluator = evaluator
+        self.threads = threads
+        self.init_worker = init_worker
+        self.change = None
+        self.error = None
+
+    def run(self):
+        try:
+            if self.geometries is not None:
+                self.handler.select(self.geometries, all_touched_cells=self.all_touched, transform=False)
+            if self.handler.selection is None or self.isCanceled():
+                return False
+            exp_values = None
+            write_start = 0
+            if self.evaluator is not None:
+                rows, cols = self.handler.selected_indices()
+                xs, ys = self.handler.cell_centers_xy(rows, cols)
+                exp_values = self.evaluator.evaluate_parallel(
+                    rows, cols, xs, ys, self.threads, init_worker=self.init_worker,
+                    feedback=PhaseFeedback(self, 0, 50))
+                if exp_values is None:
+                    return False
+                write_start = 50
+            self.change = self.handler.write_block(
+                const_values=self.const_values, raster_filter=self.raster_filter, exp_values=exp_values,
+                feedback=PhaseFeedback(self, write_start, 100))
+            self.error = self.handler.error
+            return self.change is not None
+        except Exception as err:
+            self.error = repr(err)
+            return False
+
+    def finished(self, result):
+        self.on_finished(self, result)
@@ -0,0 +1,181 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from qgis.core import (
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsExpressionNode,
+    QgsFeature,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsPointXY,
+    QgsProject,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from .utils import is_number
+
+
+bulk_data = threading.local()  # values of bulk functions calls precomputed for cells evaluated in the current thread
+
+
+def bulk_value(name, args, feature):
+    """
+    Return (True, value) if value of the function name called with args tuple was precomputed for the cell feature
+    being evaluated, or (False, None) otherwise.
+    """
+    values = getattr(bulk_data, "values", None)
+    if not values or (name, args) not in values:
+        return False, None
+    return True, values[(name, args)][feature.id()]
+
+
+def child_nodes(node):
+    """Return list of child nodes of the expression node."""
+    node_type = node.nodeType()
+    if node_type == QgsExpressionNode.ntUnaryOperator:
+        return [node.operand()]
+    if node_type == QgsExpressionNode.ntBinaryOperator:
+        return [node.opLeft(), node.opRight()]
+    if node_type == QgsExpressionNode.ntInOperator:
+        return [node.node()] + node.list().list()
+    if node_type == QgsExpressionNode.ntFunction:
+        return node.args().list() if node.args() else []
+    if node_type == QgsExpressionNode.ntCondition:
+        nodes = []
+        for when_then in node.conditions():
+            nodes.extend([when_then.whenExp(), when_then.thenExp()])
+        return nodes + ([node.elseExp()] if node.elseExp() else [])
+    if node_type == QgsExpressionNode.ntIndexOperator:
+        return [node.container(), node.index()]
+    return []
+
+
+def cell_fields():
+    """Return fields of raster cell point features."""
+    fields = QgsFields()
+    fields.append(QgsField("row", QVariant.Int))
+    fields.append(QgsField("col", QVariant.Int))
+    return fields
+
+
+class CellExpressionEvaluator(object):
+    """
+    Evaluate QGIS expression for raster cells.
+    The expression is prepared once and evaluated with a single expression context and a single feature, swapping
+    only the feature geometry (cell center point) and attributes (cell row and column) for each cell.
+    Bulk functions is a dict {function name: f(rows, cols, xs, ys, *args)} returning list of function values for all
+    the cells at once. Their calls with literal arguments found in the expression are precomputed for all cells before
+    the evaluation and the expression functions get their values using bulk_value.
+    """
+
+    FEEDBACK_CELLS = 1000  # nr of cells evaluated between progress reports
+
+    def __init__(self, exp_text, project=None, bulk_functions=None):
+        self.exp_text = exp_text
+        self.project = project if project else QgsProject.instance()
+        self.bulk_functions = bulk_functions if bulk_functions else dict()
+        self.fields = cell_fields()
+        self.expression = QgsExpression(exp_text)
+        self.context = QgsExpressionContext()
+        self.context.appendScope(QgsExpressionContextUtils.globalScope())
+        self.context.appendScope(QgsExpressionContextUtils.projectScope(self.project))
+        self.context.setFields(self.fields)
+        self.feature = QgsFeature(self.fields)
+        self.context.setFeature(self.feature)
+        self.expression.prepare(self.context)
+        self.bulk_calls = self.find_bulk_calls(self.expression.rootNode()) if self.bulk_functions else set()
+
+    def find_bulk_calls(self, node):
+        """Return set of (function name, args tuple) of bulk functions called with literal arguments in the node."""
+        calls = set()
+        if node is None:
+            return calls
+        if node.nodeType() == QgsExpressionNode.ntFunction:
+            name = QgsExpression.Functions()[node.fnIndex()].name()
+            args = child_nodes(node)
+            if name in self.bulk_functions and all(arg.nodeType() == QgsExpressionNode.ntLiteral for arg in args):
+                calls.add((name, tuple(arg.value() for arg in args)))
+        for child in child_nodes(node):
+            calls |= self.find_bulk_calls(child)
+        return calls
+
+    def precompute_bulk_calls(self, rows, cols, xs, ys):
+        """Return dict {(function name, args): values} of bulk function calls for the cells."""
+        values = dict()
+        for name, args in self.bulk_calls:
+            try:
+                values[(name, args)] = self.bulk_functions[name](rows, cols, xs, ys, *args)
+            except Exception:
+                # the call is evaluated for each cell then, reporting the error as expression evaluation error
+                continue
+        return values
+
+    def evaluate(self, rows, cols, xs, ys, feedback=None):
+        """
+        Return array of expression values for cells given as arrays of their rows, columns and center coordinates.
+        Cells with invalid or non-numeric expression value get nan.
+        If feedback (a QgsTask or QgsFeedback) is given, progress is reported and None is returned when it gets
+        canceled.
+        """
+        values = numpy.full(len(rows), numpy.nan)
+        bulk_data.values = self.precompute_bulk_calls(rows, cols, xs, ys)
+        try:
+            for nr, (row, col, x, y) in enumerate(zip(rows.tolist(), cols.tolist(), xs.tolist(), ys.tolist())):
+                if feedback is not None and nr % self.FEEDBACK_CELLS == 0:
+                    if feedback.isCanceled():
+                        return None
+                    feedback.setProgress(100. * nr / len(rows))
+                self.feature.setId(nr)
+                self.feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+                self.feature.setAttributes([row, col])
+                self.context.setFeature(self.feature)
+                val = self.expression.evaluate(self.context)
+                if self.expression.hasEvalError() or not is_number(val):
+                    continue
+                values[nr] = float(val)
+        finally:
+            bulk_data.values = None
+        return values
+
+    def evaluate_parallel(self, rows, cols, xs, ys, threads, init_worker=None, feedback=None):
+        """
+        Evaluate the expression for cells split into chunks, concurrently in a pool of threads, and merge the results
+        into a single values array. Each thread uses its own evaluator, i.e. expression and context.
+        If init_worker is given, it is called once in each thread before any evaluation, e.g. to set up layers
+        snapshots for the thread. For a single thread, the evaluation runs in the current thread.
+        If feedback is given, progress is reported for chunks evaluated and None is returned if it gets canceled.
+        """
+        if threads < 2 or len(rows) < 2 * threads:
+            if init_worker is not None:
+                init_worker()
+            return self.evaluate(rows, cols, xs, ys, feedback=feedback)
+        thread_data = threading.local()
+        lock = threading.Lock()
+        chunks_done = []
+
+        def init_thread():
+            thread_data.evaluator = CellExpressionEvaluator(self.exp_text, self.project, self.bulk_functions)
+            if init_worker is not None:
+                init_worker()
+
+        def evaluate_chunk(chunk):
+            if feedback is not None and feedback.isCanceled():
+                return None
+            chunk_values = thread_data.evaluator.evaluate(rows[chunk], cols[chunk], xs[chunk], ys[chunk])
+            if feedback is not None:
+                with lock:
+                    chunks_done.append(chunk)
+                    feedback.setProgress(100. * len(chunks_done) / len(chunks))
+            return chunk_values
+
+        # more chunks than threads to balance the load if cells evaluation cost varies
+        chunks = numpy.array_split(numpy.arange(len(rows)), threads * 4)
+        with ThreadPoolExecutor(max_workers=threads, initializer=init_thread) as pool:
+            results = list(pool.map(evaluate_chunk, chunks))
+        if any(chunk_values is None for chunk_values in results):
+            return None
+        return numpy.concatenate(results)
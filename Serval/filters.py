@@ -0,0 +1,111 @@
+import math
+import warnings
+
+import numpy
+
+from .utils import nodata_mask
+
+
+class RasterFilter(object):
+    """
+    Low-pass filter of raster cells using a square kernel of any odd size.
+    Mean, Gaussian and custom weights kernels calculate weighted average of neighbors having data, median kernel takes
+    median of them.
+    """
+
+    MEAN = "mean"
+    GAUSSIAN = "gaussian"
+    MEDIAN = "median"
+    CUSTOM = "custom"
+    KERNEL_TYPES = (MEAN, GAUSSIAN, MEDIAN, CUSTOM)
+
+    def __init__(self, kernel_type=MEAN, size=3, weights=None):
+        if kernel_type not in self.KERNEL_TYPES:
+            raise ValueError(f"Unknown filter kernel type: {kernel_type}")
+        self.kernel_type = kernel_type
+        if kernel_type == self.CUSTOM:
+            self.kernel = self.custom_kernel(weights)
+        else:
+            # the kernel must have a center cell
+            size = max(3, size + 1 if size % 2 == 0 else size)
+            if kernel_type == self.GAUSSIAN:
+                self.kernel = self.gaussian_kernel(size)
+            else:
+                self.kernel = numpy.ones((size, size))
+        self.size = self.kernel.shape[0]
+        self.radius = self.size // 2
+
+    def __repr__(self):
+        return f"RasterFilter({self.kernel_type}, {self.size}x{self.size})"
+
+    @staticmethod
+    def gaussian_kernel(size):
+        """Return Gaussian kernel weights with sigma derived from kernel size (as in OpenCV)."""
+        sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+        dist = numpy.arange(size) - size // 2
+        weights_1d = numpy.exp(-dist ** 2 / (2. * sigma ** 2))
+        return numpy.outer(weights_1d, weights_1d)
+
+    @staticmethod
+    def custom_kernel(weights):
+        """Return kernel from weights given as a list or a string of numbers separated by commas or spaces."""
+        if isinstance(weights, str):
+            weights = weights.replace(",", " ").split()
+        try:
+            weights = [float(w) for w in weights]
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid custom filter kernel weights: {weights}")
+        size = int(round(math.sqrt(len(weights))))
+        if size < 3 or size % 2 == 0 or size * size != len(weights):
+            raise ValueError("Custom filter kernel must have odd number of rows and columns, at least 3x3.")
+        return numpy.array(weights).reshape(size, size)
+
+    def apply(self, array, nodata_value, nodata_mode=False):
+        """
+        Return filtered copy of the array as float array.
+        Cells beyond the array edge are ignored, so the array should contain a halo of radius cells around the cells
+        to be filtered, if available.
+        Cells having originally nodata are not modified.
+        If nodata_mode is True, the nodata value will be return if any neighbor has nodata value. Otherwise, neighboring
+        nodata cells are ignored.
+        """
+        rows, cols = array.shape
+        rad = self.radius
+        filtered = array.astype(numpy.float64)
+        nodata = nodata_mask(array, nodata_value) | numpy.isnan(filtered)
+        # pad the arrays with cells that are neither valid nor nodata
+        values = numpy.zeros((rows + 2 * rad, cols + 2 * rad))
+        values[rad:rad + rows, rad:rad + cols] = numpy.where(nodata, 0., filtered)
+        valid = numpy.zeros(values.shape, dtype=bool)
+        valid[rad:rad + rows, rad:rad + cols] = ~nodata
+        padded_nodata = numpy.zeros(values.shape, dtype=bool)
+        padded_nodata[rad:rad + rows, rad:rad + cols] = nodata
+
+        nodata_neighbors = numpy.zeros((rows, cols), dtype=bool)
+        windows = []
+        sums = numpy.zeros((rows, cols))
+        weights_sums = numpy.zeros((rows, cols))
+        for (r, c), weight in numpy.ndenumerate(self.kernel):
+            if weight == 0:
+                continue
+            window = (slice(r, r + rows), slice(c, c + cols))
+            nodata_neighbors |= padded_nodata[window]
+            if self.kernel_type == self.MEDIAN:
+                windows.append(numpy.where(valid[window], values[window], numpy.nan))
+            else:
+                sums += weight * values[window]
+                weights_sums += weight * valid[window]
+
+        if self.kernel_type == self.MEDIAN:
+            with warnings.catch_warnings():
+                # all-nan windows produce nan and a warning
+                warnings.simplefilter("ignore", RuntimeWarning)
+                result = numpy.nanmedian(numpy.stack(windows), axis=0)
+        else:
+            result = numpy.full((rows, cols), numpy.nan)
+            numpy.divide(sums, weights_sums, out=result, where=weights_sums != 0)
+        update = ~nodata & ~numpy.isnan(result)
+        filtered[update] = result[update]
+        if nodata_mode and nodata_value is not None:
+            filtered[~nodata & nodata_neighbors] = nodata_value
+        return filtered
@@ -0,0 +1,113 @@
+import threading
+
+import numpy
+from osgeo import gdal, gdal_array
+
+
+class GdalBackend(object):
+    """
+    Direct GDAL access to raster layer data source.
+    The dataset is kept open in update mode for the whole editing session, so that edits don't need to switch the QGIS
+    data provider to editable mode, reopening the raster each time. Written blocks stay in GDAL cache until flushed
+    and the layer needs to be reloaded after flushing to show the changes.
+    A single backend is opened for each data source and shared by all its users (raster handlers), so that there are
+    never more update handles, each with its own block cache, of the same file. Each user must close the backend.
+    """
+
+    opened = dict()  # {data source uri: backend} of backends in use
+    opened_lock = threading.Lock()
+
+    def __init__(self, dataset, uri=None):
+        self.dataset = dataset
+        self.uri = uri
+        self.users = 1  # nr of users which have not closed the backend yet
+        self.dirty = False  # any block written since the last flush
+        self.lock = threading.Lock()  # GDAL dataset must not be used by more threads at once
+
+    @classmethod
+    def open(cls, layer):
+        """
+        Return backend for the raster layer data source, or None if GDAL can't open it for update. If the data source
+        is open already, its backend is shared.
+        """
+        uri = layer.dataProvider().dataSourceUri()
+        with cls.opened_lock:
+            backend = cls.opened.get(uri)
+            if backend is not None:
+                backend.users += 1
+                return backend
+            try:
+                dataset = gdal.Open(uri, gdal.GA_Update)
+            except RuntimeError:
+                return None
+            if dataset is None or dataset.RasterXSize != layer.width() or dataset.RasterYSize != layer.height():
+                return None
+            backend = cls.opened[uri] = cls(dataset, uri)
+            return backend
+
+    def read_array(self, band_nr, row, col, rows, cols):
+        """Read band block of rows x cols cells with upper left cell at (row, col) as NumPy array."""
+        with self.lock:
+            return self.dataset.GetRasterBand(band_nr).ReadAsArray(col, row, cols, rows)
+
+    def write_array(self, array, band_nr, row, col):
+        """Write the array as band block with upper left cell at (row, col). Return True on success."""
+        with self.lock:
+            self.dirty = True
+            return self.dataset.GetRasterBand(band_nr).WriteArray(array, col, row) == gdal.CE_None
+
+    def common_data_type(self, bands):
+        """Return GDAL data type of the bands, or None if they have different types."""
+        data_types = {self.dataset.GetRasterBand(band_nr).DataType for band_nr in bands}
+        return data_types.pop() if len(data_types) == 1 else None
+
+    def read_bands(self, bands, row, col, rows, cols):
+        """
+        Read blocks of rows x cols cells with upper left cell at (row, col) of all the bands with a single
+        (interleaved) read, as (bands, rows, cols) NumPy array. Return None if the bands have different data types.
+        """
+        with self.lock:
+            data_type = self.common_data_type(bands)
+            if data_type is None:
+                return None
+            data = self.dataset.ReadRaster(col, row, cols, rows, buf_type=data_type, band_list=list(bands))
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+        return numpy.frombuffer(bytearray(data), dtype=dtype).reshape(len(bands), rows, cols)
+
+    def write_bands(self, arrays, bands, row, col):
+        """
+        Write arrays of the bands as blocks with upper left cell at (row, col) with a single (interleaved) write.
+        Return True on success, or None if the bands have different data types.
+        """
+        with self.lock:
+            data_type = self.common_data_type(bands)
+            if data_type is None:
+                return None
+            dtype = gdal_array.GDALTypeCodeToNumericTypeCode(data_type)
+            data = numpy.stack(arrays).astype(dtype, copy=False).tobytes()
+            rows, cols = arrays[0].shape
+            self.dirty = True
+            res = self.dataset.WriteRaster(col, row, cols, rows, data, buf_type=data_type, band_list=list(bands))
+            return res == gdal.CE_None
+
+    def flush(self):
+        """Write cached blocks to disk. Return True if there were any blocks written since the last flush."""
+        with self.lock:
+            if not self.dirty:
+                return False
+            self.dataset.FlushCache()
+            self.dirty = False
+            return True
+
+    def close(self):
+        """Flush cached blocks and close the dataset, if there are no other users. Return True if anything flushed."""
+        flushed = self.flush()
+        with self.opened_lock:
+            self.users -= 1
+            if self.users > 0:
+                return flushed
+            if self.opened.get(self.uri) is self:
+                del self.opened[self.uri]
+        with self.lock:
+            self.dataset = None
+        return flushed
@@ -0,0 +1,206 @@
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from qgis.PyQt.QtCore import QCoreApplication, QThread
+from qgis.core import QgsFeatureRequest, QgsGeometry, QgsSpatialIndex
+
+
+def geometry_size(geom):
+    """Return estimated memory size of the geometry."""
+    return 0 if geom.isNull() else geom.constGet().nCoordinates() * 32
+
+
+class LayerCache(object):
+    """
+    Base class for caches of data derived from vector layers, keyed by layer id.
+    Data of a layer are dropped when the layer features, attributes or geometries change, or when the layer is deleted.
+    The least recently used entries are evicted when their estimated size exceeds memory budget.
+    Layer signals must be connected in the main thread (slots connected in a worker thread would be queued to a thread
+    without event loop and never called) - layers used in worker threads need to be watched before, see watch_layer.
+    Data of layers not watched are not cached in worker threads.
+    """
+
+    LAYER_SIGNALS = ("dataChanged", "featureAdded", "featureDeleted", "geometryChanged", "attributeValueChanged")
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes  # memory budget, None means no limit
+        self.entries = OrderedDict()  # {layer_id: (cached data, estimated size)}, least recently used first
+        self.layers = dict()  # {layer_id: (layer, invalidating slot, deleted slot)} of layers with connected signals
+        self.lock = threading.RLock()
+
+    def get_entry(self, layer):
+        """Return cached data of the layer and mark it as the most recently used, or None."""
+        with self.lock:
+            if layer.id() not in self.entries:
+                return None
+            self.entries.move_to_end(layer.id())
+            return self.entries[layer.id()][0]
+
+    def set_entry(self, layer, data, size):
+        """Store the layer data of estimated size and evict the least recently used entries, if needed."""
+        with self.lock:
+            if layer.id() not in self.layers:
+                if QThread.currentThread() != QCoreApplication.instance().thread():
+                    return
+                self.connect_layer(layer)
+            self.entries[layer.id()] = (data, size)
+            self.entries.move_to_end(layer.id())
+            self.evict()
+
+    def watch_layer(self, layer):
+        """Connect signals of the layer changes, so that its data can be cached, e.g. in worker threads later on."""
+        with self.lock:
+            self.connect_layer(layer)
+
+    def connect_layer(self, layer):
+        """Connect signals of layer changes to invalidate its data."""
+        if layer.id() in self.layers:
+            return
+        slot = partial(self.invalidate, layer.id())
+        deleted_slot = partial(self.layer_deleted, layer.id())
+        for signal in self.LAYER_SIGNALS:
+            getattr(layer, signal).connect(slot)
+        layer.willBeDeleted.connect(deleted_slot)
+        self.layers[layer.id()] = (layer, slot, deleted_slot)
+
+    def disconnect_layer(self, layer_id):
+        layer, slot, deleted_slot = self.layers.pop(layer_id)
+        try:
+            for signal in self.LAYER_SIGNALS:
+                getattr(layer, signal).disconnect(slot)
+            layer.willBeDeleted.disconnect(deleted_slot)
+        except (RuntimeError, TypeError):
+            # the layer was deleted already
+            pass
+
+    def layer_deleted(self, layer_id):
+        with self.lock:
+            self.entries.pop(layer_id, None)
+            self.layers.pop(layer_id, None)
+
+    def invalidate(self, layer_id, *args):
+        """Drop data of the layer. Arguments of the layer signals are ignored."""
+        with self.lock:
+            self.entries.pop(layer_id, None)
+
+    def evict(self):
+        """Remove the least recently used entries until the rest fits into memory budget. The last one is kept."""
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            total = sum(size for _, size in self.entries.values())
+            while total > self.max_bytes and len(self.entries) > 1:
+                _, (_, size) = self.entries.popitem(last=False)
+                total -= size
+
+    def clear(self):
+        """Drop all data and disconnect from layers signals."""
+        with self.lock:
+            self.entries.clear()
+            for layer_id in list(self.layers):
+                self.disconnect_layer(layer_id)
+
+
+class SpatialIndexCache(LayerCache):
+    """Cache of vector layers spatial indexes, with features geometries stored."""
+
+    LAYER_SIGNALS = ("dataChanged", "featureAdded", "featureDeleted", "geometryChanged")
+    FEATURE_OVERHEAD = 128  # estimated index memory per feature, in addition to its geometry coordinates
+
+    def get_index(self, layer, source=None):
+        """
+        Return spatial index of the layer. If the index is not cached, it is built from features of the source
+        (layer snapshot for use in worker threads) or the layer itself.
+        """
+        with self.lock:
+            index = self.get_entry(layer)
+            if index is not None:
+                return index
+            size = [0]
+
+            def add_size(feat):
+                """Feedback callback of the index building - add the feature size to the index size estimate."""
+                size[0] += self.FEATURE_OVERHEAD + geometry_size(feat.geometry())
+                return True
+
+            features = (source if source is not None else layer).getFeatures()
+            index = QgsSpatialIndex(features, add_size, QgsSpatialIndex.FlagStoreFeatureGeometries)
+            self.set_entry(layer, index, size[0])
+            return index
+
+
+class CachedFeatures(object):
+    """Geometries and attribute values of all features of a layer, read in bulk when first requested."""
+
+    VALUE_SIZE = 64  # estimated memory per attribute value
+    FEATURE_OVERHEAD = 64  # estimated memory per feature geometry, in addition to its coordinates
+
+    def __init__(self):
+        self.geometries = None  # {fid: QgsGeometry}
+        self.attributes = dict()  # {attr_name: {fid: value}}
+        self.nbytes = 0
+        self.thread_engines = threading.local()  # prepared geometry engines {fid: engine} of the current thread
+
+    def engine(self, fid):
+        """
+        Return prepared geometry engine of the feature, for fast repeated spatial predicates tests.
+        Engines are created for each thread separately, as prepared geometries are not safe to share between threads.
+        """
+        engines = getattr(self.thread_engines, "engines", None)
+        if engines is None:
+            engines = self.thread_engines.engines = dict()
+        if fid not in engines:
+            engine = QgsGeometry.createGeometryEngine(self.geometries[fid].constGet())
+            engine.prepareGeometry()
+            engines[fid] = engine
+        return engines[fid]
+
+    def load(self, source, fields, attr_names, with_geometry):
+        """
+        Read missing attributes and geometries (if requested) of all features of the source with a single request.
+        Return True if anything was read.
+        """
+        missing = [name for name in attr_names if name not in self.attributes]
+        read_geometry = with_geometry and self.geometries is None
+        if not missing and not read_geometry:
+            return False
+        request = QgsFeatureRequest().setSubsetOfAttributes(missing, fields)
+        if not read_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        new_attributes = {name: dict() for name in missing}
+        geometries = dict()
+        for feat in source.getFeatures(request):
+            fid = feat.id()
+            for name in missing:
+                new_attributes[name][fid] = feat[name]
+            if read_geometry:
+                geom = feat.geometry()
+                geometries[fid] = geom
+                self.nbytes += self.FEATURE_OVERHEAD + geometry_size(geom)
+        self.nbytes += sum(len(values) for values in new_attributes.values()) * self.VALUE_SIZE
+        self.attributes.update(new_attributes)
+        if read_geometry:
+            self.geometries = geometries
+        return True
+
+
+class FeatureCache(LayerCache):
+    """
+    Cache of vector layers features geometries and attribute values, shared by Serval expression functions.
+    All features of a layer are read at once, so that no feature is requested from the data provider repeatedly.
+    """
+
+    def get_features(self, layer, attr_names, with_geometry=True, source=None):
+        """
+        Return CachedFeatures of the layer with at least attr_names attributes (and geometries, if requested) loaded.
+        Missing data are read from the source (layer snapshot for use in worker threads) or the layer itself.
+        """
+        with self.lock:
+            features = self.get_entry(layer)
+            if features is None:
+                features = CachedFeatures()
+            source = source if source is not None else layer
+            if features.load(source, layer.fields(), attr_names, with_geometry) or layer.id() not in self.entries:
+                self.set_entry(layer, features, features.nbytes)
+            return features
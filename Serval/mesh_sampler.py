@@ -0,0 +1,181 @@
+import numpy
+from qgis.core import QgsMesh, QgsMeshDatasetGroupMetadata, QgsMeshDatasetIndex
+
+from .layer_cache import LayerCache
+
+
+class MeshSampler(object):
+    """
+    Sampler of a mesh dataset values at points.
+    Mesh faces are triangulated and indexed in regular grids of buckets, so that values for many points are
+    interpolated (barycentric interpolation of vertex values, or values of faces) in a single vectorized pass.
+    """
+
+    CHUNK_POINTS = 2 ** 20  # nr of points sampled at once, limits memory used by candidate triangles
+    LEVEL_FACTOR = 4  # ratio of bucket sizes of consecutive grid levels
+
+    def __init__(self, vertices, triangles, values, on_vertices=True, tri_faces=None):
+        """
+        Vertices is (n, 2) array of x, y coordinates, triangles (m, 3) array of vertex indices. Values are dataset
+        values of vertices, or of faces given as tri_faces array of face index of each triangle.
+        """
+        self.values = numpy.asarray(values, dtype=float)
+        self.on_vertices = on_vertices
+        self.triangles = numpy.asarray(triangles, dtype=numpy.int64).reshape(-1, 3)
+        self.tri_faces = tri_faces
+        vertices = numpy.asarray(vertices, dtype=float).reshape(-1, 2)
+        self.tri_x = vertices[self.triangles, 0]
+        self.tri_y = vertices[self.triangles, 1]
+        self.build_grid()
+
+    @classmethod
+    def from_layer(cls, mesh_layer, group, dataset):
+        """Load the mesh and the dataset values from the mesh layer data provider."""
+        provider = mesh_layer.dataProvider()
+        mesh = QgsMesh()
+        provider.populateMesh(mesh)
+        vertices = [(vertex.x(), vertex.y()) for vertex in (mesh.vertex(i) for i in range(mesh.vertexCount()))]
+        ds_index = QgsMeshDatasetIndex(group, dataset)
+        active = provider.areFacesActive(ds_index, 0, mesh.faceCount())
+        triangles = []
+        tri_faces = []
+        for face_nr in range(mesh.faceCount()):
+            if active.isValid() and not active.active(face_nr):
+                continue
+            face = mesh.face(face_nr)
+            for i in range(1, len(face) - 1):
+                triangles.append((face[0], face[i], face[i + 1]))
+                tri_faces.append(face_nr)
+        on_vertices = provider.datasetGroupMetadata(group).dataType() == QgsMeshDatasetGroupMetadata.DataOnVertices
+        count = mesh.vertexCount() if on_vertices else mesh.faceCount()
+        block = provider.datasetValues(ds_index, 0, count)
+        values = [block.value(i).scalar() for i in range(count)]
+        return cls(vertices, triangles, values, on_vertices, numpy.array(tri_faces, dtype=numpy.int64))
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.values, self.triangles, self.tri_x, self.tri_y)) + \
+            sum(level.bucket_keys.nbytes + level.bucket_tris.nbytes for level in self.levels)
+
+    def build_grid(self):
+        """
+        Assign triangles to levels of regular grids of buckets covering their bounding boxes. Bucket size grows by
+        LEVEL_FACTOR from level to level and each triangle is indexed at the level with buckets not smaller than its
+        bounding box, so that a triangle fills at most 4 buckets, even for meshes mixing fine and coarse faces.
+        """
+        self.levels = []
+        if len(self.triangles) == 0:
+            return
+        x_min, x_max = self.tri_x.min(axis=1), self.tri_x.max(axis=1)
+        y_min, y_max = self.tri_y.min(axis=1), self.tri_y.max(axis=1)
+        extents = numpy.maximum(x_max - x_min, y_max - y_min)
+        base_size = max(numpy.percentile(extents, 10), 1e-9)
+        with numpy.errstate(divide="ignore"):
+            tri_levels = numpy.ceil(numpy.log(extents / base_size) / numpy.log(self.LEVEL_FACTOR))
+        tri_levels = numpy.clip(numpy.nan_to_num(tri_levels, neginf=0.), 0, None).astype(numpy.int64)
+        for level_nr in numpy.unique(tri_levels).tolist():
+            tris = numpy.flatnonzero(tri_levels == level_nr)
+            level = GridLevel(base_size * self.LEVEL_FACTOR ** level_nr, x_min[tris].min(), y_min[tris].min())
+            level.build(tris, x_min[tris], x_max[tris], y_min[tris], y_max[tris])
+            self.levels.append(level)
+
+    def sample(self, xs, ys):
+        """Return array of dataset values at points xs, ys. Points outside the mesh get nan."""
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        values = numpy.full(len(xs), numpy.nan)
+        for start in range(0, len(xs), self.CHUNK_POINTS):
+            chunk = slice(start, start + self.CHUNK_POINTS)
+            values[chunk] = self.sample_chunk(xs[chunk], ys[chunk])
+        return values
+
+    def sample_chunk(self, xs, ys):
+        values = numpy.full(len(xs), numpy.nan)
+        if not self.levels:
+            return values
+        # pairs of points and candidate triangles from their buckets at all levels
+        pairs = [level.candidates(xs, ys) for level in self.levels]
+        pair_pts = numpy.concatenate([level_pts for level_pts, _ in pairs])
+        pair_tris = numpy.concatenate([level_tris for _, level_tris in pairs])
+        px, py = xs[pair_pts], ys[pair_pts]
+        x0, x1, x2 = self.tri_x[pair_tris].T
+        y0, y1, y2 = self.tri_y[pair_tris].T
+        det = (y1 - y2) * (x0 - x2) + (x2 - x1) * (y0 - y2)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            l0 = ((y1 - y2) * (px - x2) + (x2 - x1) * (py - y2)) / det
+            l1 = ((y2 - y0) * (px - x2) + (x0 - x2) * (py - y2)) / det
+        l2 = 1. - l0 - l1
+        eps = -1e-9
+        inside = (det != 0) & (l0 >= eps) & (l1 >= eps) & (l2 >= eps)
+        pair_pts, pair_tris = pair_pts[inside], pair_tris[inside]
+        l0, l1, l2 = l0[inside], l1[inside], l2[inside]
+        # points on edges shared by more triangles take the first one (pairs are sorted by points for that)
+        order = numpy.argsort(pair_pts, kind="stable")
+        pair_pts, pair_tris = pair_pts[order], pair_tris[order]
+        l0, l1, l2 = l0[order], l1[order], l2[order]
+        pair_pts, hit = numpy.unique(pair_pts, return_index=True)
+        pair_tris = pair_tris[hit]
+        if self.on_vertices:
+            tri_values = self.values[self.triangles[pair_tris]]
+            values[pair_pts] = l0[hit] * tri_values[:, 0] + l1[hit] * tri_values[:, 1] + l2[hit] * tri_values[:, 2]
+        else:
+            values[pair_pts] = self.values[self.tri_faces[pair_tris]]
+        return values
+
+
+class GridLevel(object):
+    """Regular grid of buckets of the size, with triangles assigned to buckets covering their bounding boxes."""
+
+    def __init__(self, bucket_size, origin_x, origin_y):
+        self.bucket_size = bucket_size
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.grid_cols = self.grid_rows = 0
+        self.bucket_keys = self.bucket_tris = numpy.zeros(0, dtype=numpy.int64)
+
+    def bucket_indices(self, coords, origin):
+        return numpy.floor((coords - origin) / self.bucket_size).astype(numpy.int64)
+
+    def build(self, tris, x_min, x_max, y_min, y_max):
+        """Assign triangles (indices) with the bounding boxes to the buckets."""
+        col_0, col_1 = self.bucket_indices(x_min, self.origin_x), self.bucket_indices(x_max, self.origin_x)
+        row_0, row_1 = self.bucket_indices(y_min, self.origin_y), self.bucket_indices(y_max, self.origin_y)
+        self.grid_cols, self.grid_rows = int(col_1.max()) + 1, int(row_1.max()) + 1
+        widths = col_1 - col_0 + 1
+        counts = widths * (row_1 - row_0 + 1)
+        items = numpy.repeat(numpy.arange(len(tris)), counts)
+        local = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        cols = col_0[items] + local % widths[items]
+        rows = row_0[items] + local // widths[items]
+        keys = rows * self.grid_cols + cols
+        order = numpy.argsort(keys, kind="stable")
+        self.bucket_keys = keys[order]
+        self.bucket_tris = tris[items[order]]
+
+    def candidates(self, xs, ys):
+        """Return arrays of point indices and triangles from buckets of the points - pairs to test."""
+        cols = self.bucket_indices(xs, self.origin_x)
+        rows = self.bucket_indices(ys, self.origin_y)
+        pts = numpy.flatnonzero((cols >= 0) & (cols < self.grid_cols) & (rows >= 0) & (rows < self.grid_rows))
+        keys = rows[pts] * self.grid_cols + cols[pts]
+        first = numpy.searchsorted(self.bucket_keys, keys, side="left")
+        counts = numpy.searchsorted(self.bucket_keys, keys, side="right") - first
+        local = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return numpy.repeat(pts, counts), self.bucket_tris[numpy.repeat(first, counts) + local]
+
+
+class MeshSamplerCache(LayerCache):
+    """Cache of mesh samplers, keyed by mesh layer id and holding a sampler for each (group, dataset) used."""
+
+    LAYER_SIGNALS = ("dataChanged", )
+
+    def get_sampler(self, mesh_layer, group, dataset):
+        """Return sampler of the mesh layer dataset, loading the mesh if it is not cached yet."""
+        with self.lock:
+            samplers = self.get_entry(mesh_layer)
+            if samplers is None:
+                samplers = dict()
+            if (group, dataset) not in samplers:
+                samplers[(group, dataset)] = MeshSampler.from_layer(mesh_layer, group, dataset)
+                self.set_entry(mesh_layer, samplers, sum(sampler.nbytes for sampler in samplers.values()))
+            return samplers[(group, dataset)]
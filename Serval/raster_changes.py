@@ -1,53 +1,298 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy
 from qgis.PyQt.QtCore import QObject
 
 
 class RasterChange(object):
-    """Class for storing a change made to raster, i.e. raster blocks before and after the change."""
+    """
+    Class for storing a change made to raster.
+    For each tile and band only the changed cells are kept, i.e. their indices within the tile and values before and
+    after the change, packed into a single zlib compressed buffer.
+    """
 
-    def __init__(self, active_bands, row, col, old_blocks, new_blocks):
+    def __init__(self, active_bands):
         self.active_bands = active_bands  # list of bands for the change
-        self.row = row  # top left row and col of the blocks with changes
-        self.col = col
-        self.old_blocks = old_blocks  # list of blocks for each raster band
-        self.new_blocks = new_blocks
+        self.tiles = []  # list of (row, col, rows, cols, band_cells) - top left row and col, size and cells of bands
+        self.nbytes = 0  # size of compressed cells data
+
+    def add_tile(self, row, col, old_arrays, new_arrays):
+        """Store changed cells of the tile arrays (with upper left cell at row, col) for each active band."""
+        rows, cols = old_arrays[0].shape
+        idx_type = numpy.dtype(numpy.uint32 if rows * cols < 2 ** 32 else numpy.uint64)
+        band_cells = []
+        nr_changed = 0
+        for old_array, new_array in zip(old_arrays, new_arrays):
+            # compare the cells bitwise, so that nan values are compared properly
+            uint_type = f"u{old_array.dtype.itemsize}"
+            old_flat = numpy.ascontiguousarray(old_array).reshape(-1)
+            new_flat = numpy.ascontiguousarray(new_array).reshape(-1)
+            changed = numpy.flatnonzero(old_flat.view(uint_type) != new_flat.view(uint_type))
+            packed = changed.astype(idx_type).tobytes() + old_flat[changed].tobytes() + new_flat[changed].tobytes()
+            data = zlib.compress(packed, 1)
+            band_cells.append((old_array.dtype.str, changed.size, data))
+            nr_changed += changed.size
+        if nr_changed == 0:
+            return
+        self.tiles.append((row, col, rows, cols, band_cells))
+        self.nbytes += sum(len(data) for _, _, data in band_cells)
+
+    @staticmethod
+    def unpack(rows, cols, dtype, count, data):
+        """Return arrays of changed cells flat indices, old and new values from the packed data."""
+        idx_type = numpy.dtype(numpy.uint32 if rows * cols < 2 ** 32 else numpy.uint64)
+        dtype = numpy.dtype(dtype)
+        raw = zlib.decompress(data)
+        indices = numpy.frombuffer(raw, idx_type, count)
+        old_offset = count * idx_type.itemsize
+        new_offset = old_offset + count * dtype.itemsize
+        return indices, numpy.frombuffer(raw, dtype, count, old_offset), numpy.frombuffer(raw, dtype, count, new_offset)
+
+    def tile_cells(self, old=True):
+        """
+        Yield (row, col, rows, cols, band_cells) for each tile, band_cells being (indices, values) for each band.
+        Tiles may overlap (e.g. cells painted repeatedly in one stroke), so old values are yielded in reverse order.
+        """
+        for row, col, rows, cols, band_cells in (reversed(self.tiles) if old else self.tiles):
+            cells = []
+            for dtype, count, data in band_cells:
+                indices, old_values, new_values = self.unpack(rows, cols, dtype, count, data)
+                cells.append((indices, old_values if old else new_values))
+            yield row, col, rows, cols, cells
+
+    def restore_old_values(self, band_nr, array, row, col):
+        """Overwrite the array cells (with upper left cell at row, col) with the band values before the change."""
+        idx = self.active_bands.index(band_nr)
+        rows, cols = array.shape
+        for tile_row, tile_col, tile_rows, tile_cols, band_cells in reversed(self.tiles):
+            if tile_row >= row + rows or row >= tile_row + tile_rows or \
+                    tile_col >= col + cols or col >= tile_col + tile_cols:
+                continue
+            indices, old_values, _ = self.unpack(tile_rows, tile_cols, *band_cells[idx])
+            cell_rows = indices // tile_cols + tile_row - row
+            cell_cols = indices % tile_cols + tile_col - col
+            inside = (cell_rows >= 0) & (cell_rows < rows) & (cell_cols >= 0) & (cell_cols < cols)
+            array[cell_rows[inside], cell_cols[inside]] = old_values[inside]
+
+    def to_bytes(self):
+        """Serialize the change as JSON header with tiles description followed by compressed cells data."""
+        tiles_meta = []
+        for row, col, rows, cols, band_cells in self.tiles:
+            tiles_meta.append([row, col, rows, cols, [[dtype, count, len(data)] for dtype, count, data in band_cells]])
+        meta = json.dumps({"bands": self.active_bands, "tiles": tiles_meta}).encode()
+        data = [data for _, _, _, _, band_cells in self.tiles for _, _, data in band_cells]
+        return b"".join([struct.pack("<I", len(meta)), meta] + data)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        """Create the change from serialized bytes (or any buffer, like a memory map slice)."""
+        buf = memoryview(buf)
+        meta_len = struct.unpack_from("<I", buf)[0]
+        meta = json.loads(bytes(buf[4:4 + meta_len]))
+        change = cls(meta["bands"])
+        offset = 4 + meta_len
+        for row, col, rows, cols, cells_meta in meta["tiles"]:
+            band_cells = []
+            for dtype, count, size in cells_meta:
+                band_cells.append((dtype, count, bytes(buf[offset:offset + size])))
+                offset += size
+            change.tiles.append((row, col, rows, cols, band_cells))
+            change.nbytes += sum(size for _, _, size in cells_meta)
+        return change
 
     def get_undo(self):
-        return self.active_bands, self.row, self.col, self.old_blocks
+        return self.active_bands, self.tile_cells(old=True)
 
     def get_redo(self):
-        return self.active_bands, self.row, self.col, self.new_blocks
+        return self.active_bands, self.tile_cells(old=False)
+
+
+class ChangeJournal(object):
+    """
+    Append-only file journal of raster changes, allowing for deep undo history without keeping it in memory and for
+    its recovery after QGIS restart or crash.
+    The file starts with a header describing the raster, followed by records of kind (change, undo or redo), payload
+    length and payload - serialized RasterChange for change records. Change records are read using memory map.
+    """
+
+    MAGIC = b"SERVALJ1"
+    CHANGE = b"C"
+    UNDO = b"U"
+    REDO = b"R"
+    RECORD_HEADER = struct.Struct("<cQ")
+
+    def __init__(self, path, raster_meta):
+        self.path = path
+        self.raster_meta = raster_meta  # dict describing the raster, must match the existing journal file header
+        self.records = []  # list of (kind, payload offset, payload length) of existing records
+        if not self.read_records():
+            self.create()
+
+    def create(self, path=None):
+        header = json.dumps(self.raster_meta).encode()
+        with open(path or self.path, "wb") as journal:
+            journal.write(self.MAGIC + struct.pack("<I", len(header)) + header)
+        self.records = []
+
+    def read_records(self):
+        """Read records of existing journal file. Return False if there is no valid journal for the raster."""
+        try:
+            with open(self.path, "rb") as journal:
+                if journal.read(len(self.MAGIC)) != self.MAGIC:
+                    return False
+                header_len = struct.unpack("<I", journal.read(4))[0]
+                if json.loads(journal.read(header_len)) != self.raster_meta:
+                    return False
+                while True:
+                    rec_header = journal.read(self.RECORD_HEADER.size)
+                    if len(rec_header) < self.RECORD_HEADER.size:
+                        break
+                    kind, length = self.RECORD_HEADER.unpack(rec_header)
+                    offset = journal.tell()
+                    if offset + length > os.fstat(journal.fileno()).st_size:
+                        # incomplete record written when crashed
+                        break
+                    self.records.append((kind, offset, length))
+                    journal.seek(length, os.SEEK_CUR)
+        except (OSError, ValueError, struct.error):
+            return False
+        return True
+
+    def append(self, kind, payload=b""):
+        """Append a record to the journal and make sure it is stored on disk. Return payload offset and length."""
+        with open(self.path, "r+b") as journal:
+            journal.seek(0, os.SEEK_END)
+            journal.write(self.RECORD_HEADER.pack(kind, len(payload)))
+            offset = journal.tell()
+            journal.write(payload)
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.records.append((kind, offset, len(payload)))
+        return offset, len(payload)
+
+    def read_change(self, entry):
+        """Return RasterChange stored in the journal at (offset, length) entry."""
+        offset, length = entry
+        with open(self.path, "rb") as journal:
+            with mmap.mmap(journal.fileno(), 0, access=mmap.ACCESS_READ) as journal_map:
+                return RasterChange.from_bytes(journal_map[offset:offset + length])
+
+    def compact(self, undos, redos):
+        """
+        Rewrite the journal with only the undo and redo entries given and return their new entries.
+        Changes are written in chronological order, followed by an undo record for each redo entry. Payloads are copied
+        record by record from the memory mapped journal, so that they are never all in memory at once.
+        """
+        temp_path = self.path + ".tmp"
+        self.create(temp_path)
+        entries = undos + list(reversed(redos))
+        new_entries = []
+        with open(self.path, "rb") as journal, open(temp_path, "r+b") as temp:
+            temp.seek(0, os.SEEK_END)
+            with mmap.mmap(journal.fileno(), 0, access=mmap.ACCESS_READ) as journal_map:
+                for offset, length in entries:
+                    temp.write(self.RECORD_HEADER.pack(self.CHANGE, length))
+                    new_entries.append((temp.tell(), length))
+                    self.records.append((self.CHANGE, temp.tell(), length))
+                    temp.write(journal_map[offset:offset + length])
+            for _ in redos:
+                temp.write(self.RECORD_HEADER.pack(self.UNDO, 0))
+                self.records.append((self.UNDO, temp.tell(), 0))
+            temp.flush()
+            os.fsync(temp.fileno())
+        os.replace(temp_path, self.path)
+        new_undos = new_entries[:len(undos)]
+        new_redos = list(reversed(new_entries[len(undos):]))
+        return new_undos, new_redos
 
 
 class RasterChanges(QObject):
-    """Class for managing changes made to a raster."""
+    """
+    Class for managing changes made to a raster.
+    If a journal (ChangeJournal instance) is given, the changes are kept on disk and undo / redo stacks contain only
+    the journal entries.
+    """
 
-    def __init__(self, nr_to_keep=3):
+    def __init__(self, nr_to_keep=3, max_bytes=None, journal=None):
         super(RasterChanges, self).__init__()
-        self.undos = []  # list of RasterChange objects
+        self.undos = []  # list of RasterChange objects or journal entries
         self.redos = []
         self.nr_to_keep = nr_to_keep
+        self.max_bytes = max_bytes  # memory budget for stored changes, None means no limit
+        self.journal = journal
+        if self.journal is not None:
+            self.replay_journal()
+
+    def replay_journal(self):
+        """Recreate undo / redo stacks from the journal records."""
+        for kind, offset, length in self.journal.records:
+            if kind == ChangeJournal.CHANGE:
+                self.push_change((offset, length))
+            elif kind == ChangeJournal.UNDO and self.undos:
+                self.push_redo(self.undos.pop())
+            elif kind == ChangeJournal.REDO and self.redos:
+                self.undos.append(self.redos.pop())
 
     def clear(self):
         self.undos = []
         self.redos = []
+        if self.journal is not None:
+            self.journal.create()
 
-    def add_change(self, change):
+    def nbytes(self):
+        if self.journal is not None:
+            return 0
+        return sum(change.nbytes for change in self.undos + self.redos)
+
+    def evict(self):
+        """Remove the oldest changes until all the changes fit into memory budget. The last change is always kept."""
+        if self.max_bytes is None:
+            return
+        total = self.nbytes()
+        while total > self.max_bytes and self.redos:
+            total -= self.redos.pop(0).nbytes
+        while total > self.max_bytes and len(self.undos) > 1:
+            total -= self.undos.pop(0).nbytes
+
+    def push_change(self, change):
         keep = max(0, self.nr_to_keep - 1)
-        self.undos = self.undos[-keep:]
+        self.undos = self.undos[-keep:] if keep else []
         self.undos.append(change)
         self.redos = []
 
+    def push_redo(self, change):
+        keep = max(0, self.nr_to_keep - 1)
+        self.redos = self.redos[-keep:] if keep else []
+        self.redos.append(change)
+
+    def add_change(self, change):
+        if self.journal is not None:
+            change = self.journal.append(ChangeJournal.CHANGE, change.to_bytes())
+        self.push_change(change)
+        self.evict()
+        if self.journal is not None and len(self.journal.records) > 2 * self.nr_to_keep + 10:
+            self.undos, self.redos = self.journal.compact(self.undos, self.redos)
+
+    def get_change(self, change):
+        return self.journal.read_change(change) if self.journal is not None else change
+
     def undo(self):
         last_change = self.undos.pop()
-        keep = max(0, self.nr_to_keep - 1)
-        self.redos = self.redos[-keep:]
-        self.redos.append(last_change)
-        return last_change.get_undo()
+        self.push_redo(last_change)
+        if self.journal is not None:
+            self.journal.append(ChangeJournal.UNDO)
+        return self.get_change(last_change).get_undo()
 
     def redo(self):
         last_change = self.redos.pop()
         self.undos.append(last_change)
-        return last_change.get_redo()
+        if self.journal is not None:
+            self.journal.append(ChangeJournal.REDO)
+        return self.get_change(last_change).get_redo()
 
     def nr_undos(self):
         return len(self.undos)
@@ -1,5 +1,9 @@
 import math
+import threading
+from collections import OrderedDict
+from itertools import islice
 
+import numpy
 from qgis.core import (
     QgsCoordinateTransform,
     QgsCsException,
@@ -7,13 +11,21 @@ from qgis.core import (
     QgsGeometry,
     QgsPointXY,
     QgsProject,
-    QgsRasterBlock,
     QgsRectangle,
-    QgsSpatialIndex,
     QgsVectorLayer,
 )
 from qgis.PyQt.QtCore import pyqtSignal, QObject
-from .utils import get_logger, dtypes, low_pass_filtered
+from .utils import (
+    array_to_block,
+    block_to_array,
+    dtypes,
+    get_logger,
+    nodata_mask,
+    rasterize_geometries,
+)
+from .cell_selection import CellSelection, mask_runs
+from .edit_overlay import EditOverlay, OverlayRasterInterface
+from .gdal_backend import GdalBackend
 from .raster_changes import RasterChange
 
 
@@ -21,8 +33,14 @@ class RasterHandler(QObject):
     """Raster layer handler."""
 
     raster_changed = pyqtSignal(object)
+    VALUE_CACHE_TILE = 256  # size of raster tiles cached for cell values lookups
+    VALUE_CACHE_TILES = 64  # max nr of cached tiles
+    CELLS_TILE = 256  # max size of blocks read and written for cells given by their indices
+    STRIP_ROWS = 256  # nr of rows rasterized at once when selecting cells
+    SPARSE_TILE = 256  # size of tiles written for sparse selections, if tile_size is not set
+    SPARSE_FILL = 0.25  # selections with smaller fraction of the block cells selected are sparse
 
-    def __init__(self, layer, uc=None, debug=False):
+    def __init__(self, layer, uc=None, debug=False, tile_size=0, use_gdal=False, selection_cache=None):
         super(RasterHandler, self).__init__()
         self.layer = layer
         self.uc = uc
@@ -49,20 +67,25 @@ class RasterHandler(QObject):
         self.origin_y = self.max_y
         self.first_pixel_x = self.min_x + self.pixel_size_x / 2.  # x coord of upper left pixel center
         self.first_pixel_y = self.max_y - self.pixel_size_y / 2.  # y
-        self.cell_centers = None  # dict of coordinates of currently selected cells centers {(row, col): (x, y)}
-        self.cell_exp_val = None  # dict of evaluated expressions for cells centers {(row, col): value}
+        # raster grid and CRS, identifying selections of the same cells
+        self.grid = (self.layer.crs().toWkt(), self.origin_x, self.origin_y, self.pixel_size_x, self.pixel_size_y,
+                     self.raster_rows, self.raster_cols)
+        self.selection_cache = selection_cache  # SelectionCache shared by handlers, if used
+        self.selection_version = 0  # incremented with each selection change
+        self.cell_pts_key = None  # (selection version, max cells) of the cell points layer
         self.cell_pts_layer = None  # point memory layer with selected cells centers
         self.selecting_geoms = None  # dictionary of selecting geometries {id: geometry}
-        self.spatial_index = None  # spatial index of selecting geometries extents
-        self.block_row_min = None  # range of indices of the raster block to modify
-        self.block_row_max = None
-        self.block_col_min = None
-        self.block_col_max = None
-        self.selected_cells = None  # list of selected cells as tuples of global indices (row, cell)
-        self.selected_cells_feats = None  # {(row, cell): feature}
-        self.total_geometry = None
+        self.selection = None  # CellSelection of currently selected cells, None if there are none
         self.all_touched_cells = None
-        self.exp_field_idx = None
+        self.tile_size = tile_size  # size of tiles for processing the block, 0 means whole block at once
+        self.error = None  # message of the last write error
+        self.value_cache = OrderedDict()  # {(band_nr, tile_row, tile_col): array}, least recently used first
+        self.value_cache_lock = threading.Lock()
+        self.backend = GdalBackend.open(layer) if use_gdal else None  # direct GDAL access, if used and possible
+        self.reload_needed = False  # the layer needs reloading to show changes written by the GDAL backend
+        self.overlay = None  # EditOverlay with modified tiles not committed yet, if edit session is started
+        self.overlay_interface = None  # raster pipe interface rendering the overlay
+        self.stroke_editing = False  # the data provider is kept in editing mode during a drawing stroke
         self.get_data_types()
         self.get_nodata_values()
 
@@ -97,28 +120,17 @@ class RasterHandler(QObject):
                     # leave nodata undefined
                     self.nodata_values.append(None)
 
-    def select(self, geometries, all_touched_cells=True, transform=True):
+    def transform_geometries(self, geometries):
         """
-        For the geometries list, find selected cells.
-        If all_touched_cells is True, all cells touching a geometry will be selected.
-        Otherwise, a geometry must intersect a cell center to select it.
+        Return copies of valid geometries from the list, transformed to the raster CRS, if needed.
+        If the transformation fails, None is returned.
         """
-        if self.logger:
-            self.logger.debug(f"Selecting cells for geometries: {[g.asWkt() for g in geometries]}")
-        if not geometries:
-            self.uc.bar_warn("Select some raster cells!")
-            return
-        self.selecting_geoms = dict()
-        self.selected_cells = []
-        self.spatial_index = QgsSpatialIndex()
-        self.total_geometry = QgsGeometry()
-        dxy = 0.001
-        geoms = []
-        for nr, geom in enumerate(geometries):
+        transformed = []
+        for geom in geometries:
             if not geom.isGeosValid():
                 continue
             sgeom = QgsGeometry(geom)
-            if self.crs_transform and transform:
+            if self.crs_transform:
                 try:
                     res = sgeom.transform(self.crs_transform)
                     if not res == QgsGeometry.Success:
@@ -130,145 +142,648 @@ class RasterHandler(QObject):
                     msg += repr(err)
                     if self.logger:
                         self.logger.warning(msg)
-                    return
+                    return None
+            transformed.append(sgeom)
+        return transformed
 
-            self.selecting_geoms[nr] = sgeom
-            self.spatial_index.addFeature(nr, sgeom.boundingBox())
-            geoms.append(sgeom)
-        self.total_geometry = QgsGeometry.unaryUnion(geoms)
+    def select(self, geometries, all_touched_cells=True, transform=True):
+        """
+        For the geometries list, find selected cells.
+        If all_touched_cells is True, all cells touching a geometry will be selected.
+        Otherwise, a geometry must intersect a cell center to select it.
+        The geometries are burnt into a boolean mask of the block in a single rasterization pass.
+        If transform is False, the geometries are expected to be valid and in raster CRS - then no user messages are
+        shown and the selection can be run in a background thread.
+        """
         if self.logger:
-            self.logger.debug(f"Total selecting geometry bbox: {self.total_geometry.boundingBox()}")
-        self.block_row_min, self.block_row_max, self.block_col_min, self.block_col_max = \
-            self.extent_to_cell_indices(self.total_geometry.boundingBox())
-
-        half_pix_x = self.pixel_size_x / 2.
-        half_pix_y = self.pixel_size_y / 2.
-        self.cell_centers = dict()
-        for row in range(self.block_row_min, self.block_row_max + 1):
-            for col in range(self.block_col_min, self.block_col_max + 1):
-                pt_x = self.first_pixel_x + col * self.pixel_size_x
-                pt_y = self.first_pixel_y - row * self.pixel_size_y
-                if all_touched_cells:
-                    bbox = QgsRectangle(pt_x - half_pix_x, pt_y - half_pix_y,
-                                        pt_x + half_pix_x, pt_y + half_pix_y)
-                else:
-                    bbox = QgsRectangle(pt_x, pt_y, pt_x + dxy, pt_y + dxy)
-                sel_inter = self.spatial_index.intersects(bbox)
-                for sel_geom_id in sel_inter:
-                    g = self.selecting_geoms[sel_geom_id]
-                    if g.intersects(bbox):
-                        self.selected_cells.append((row, col))
-                        self.cell_centers[(row, col)] = (pt_x, pt_y)
+            self.logger.debug(f"Selecting cells for geometries: {[g.asWkt() for g in geometries]}")
+        if not geometries:
+            self.uc.bar_warn("Select some raster cells!")
+            return
+        self.clear_selection(all_touched_cells)
+        if transform:
+            geometries = self.transform_geometries(geometries)
+            if geometries is None:
+                return
+        self.selecting_geoms = dict(enumerate(geometries))
+        key = None
+        if self.selection_cache is not None:
+            key = self.selection_cache.fingerprint(geometries, all_touched_cells, self.grid)
+            selection = self.selection_cache.get(key)
+            if selection is not None:
+                if self.logger:
+                    self.logger.debug(f"Selection {key} found in cache")
+                self.selection = selection
+                return
+        self.set_selection(self.rasterize(geometries))
+        if key is not None:
+            self.selection_cache.put(key, self.selection)
+
+    def clear_selection(self, all_touched_cells=True):
+        """Clear the selection, the cells will be selected with the all_touched_cells rule from now on."""
+        self.selecting_geoms = dict()
+        self.selection = None
+        self.all_touched_cells = all_touched_cells
+        self.selection_version += 1
+
+    def geometries_window(self, geometries):
+        """Return (row_min, row_max, col_min, col_max) window of cells covering the geometries extent, or None."""
+        sel_extent = None
+        for geom in geometries:
+            if sel_extent is None:
+                sel_extent = geom.boundingBox()
+            else:
+                sel_extent.combineExtentWith(geom.boundingBox())
+        if sel_extent is None:
+            return None
         if self.logger:
-            self.logger.debug(f"Nr of cells selected: {len(self.selected_cells)}")
+            self.logger.debug(f"Total selecting geometry bbox: {sel_extent}")
+        return self.extent_to_cell_indices(sel_extent)
+
+    def rasterize(self, geometries, window=None):
+        """
+        Burn the geometries (in raster CRS) into selection of cells covering their extent, or the window
+        (row_min, row_max, col_min, col_max), if given. Return CellSelection, or None if no cell is selected.
+        The window is burnt in strips of STRIP_ROWS rows and only columns covered by the geometries parts within a strip
+        are burnt, so that the cost scales with the selected cells rather than the window area, e.g. for long diagonal
+        line selections.
+        """
+        geometries = [geom for geom in geometries if not geom.isEmpty()]
+        if window is None:
+            window = self.geometries_window(geometries)
+            if window is None:
+                return None
+        row_min, row_max, col_min, col_max = window
+        bboxes = [geom.boundingBox() for geom in geometries]
+        y_min = numpy.array([bbox.yMinimum() for bbox in bboxes])
+        y_max = numpy.array([bbox.yMaximum() for bbox in bboxes])
+        runs = []
+        for strip_row in range(row_min, row_max + 1, self.STRIP_ROWS):
+            strip_rows = min(self.STRIP_ROWS, row_max + 1 - strip_row)
+            # geometries are clipped to the strip extended by a cell on each side, so that the strip cells are burnt
+            # exactly as by the whole geometries
+            clip_rect = self.block_extent(strip_row - 1, col_min - 1, strip_rows + 2, col_max - col_min + 3)
+            in_strip = numpy.flatnonzero((y_max >= clip_rect.yMinimum()) & (y_min <= clip_rect.yMaximum()))
+            parts = []
+            for nr in in_strip.tolist():
+                if not bboxes[nr].intersects(clip_rect):
+                    continue
+                part = geometries[nr].clipped(clip_rect)
+                if part.isEmpty():
+                    continue
+                _, _, part_col_min, part_col_max = self.extent_to_cell_indices(part.boundingBox())
+                parts.append((max(part_col_min - 1, col_min), min(part_col_max + 1, col_max), part))
+            for group_col_min, group_col_max, group in self.column_groups(parts):
+                x_min, y_top = self.index_to_point(strip_row, group_col_min)
+                mask = rasterize_geometries(
+                    group, x_min, y_top, self.pixel_size_x, self.pixel_size_y, strip_rows,
+                    group_col_max - group_col_min + 1, all_touched=self.all_touched_cells)
+                runs.append(mask_runs(mask, strip_row, group_col_min))
+        if not runs:
+            return None
+        return CellSelection.from_runs(*(numpy.concatenate(arrays) for arrays in zip(*runs)))
 
-    def create_cell_pts_layer(self):
-        """For current block extent, create memory point layer with a feature in each selected cell."""
+    @staticmethod
+    def column_groups(parts):
+        """Merge (col_min, col_max, geometry) parts with overlapping columns into (col_min, col_max, geometries)."""
+        groups = []
+        for part_col_min, part_col_max, part in sorted(parts, key=lambda p: p[0]):
+            if groups and part_col_min <= groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], part_col_max)
+                groups[-1][2].append(part)
+            else:
+                groups.append([part_col_min, part_col_max, [part]])
+        return groups
+
+    def add_to_selection(self, geometries, transform=True):
+        """
+        Add cells of the geometries to current selection - only the new geometries are rasterized and their runs are
+        merged with the selection. Return False if the geometries transformation failed.
+        """
+        if transform:
+            geometries = self.transform_geometries(geometries)
+            if geometries is None:
+                return False
+        added = self.rasterize(geometries)
+        if added is None:
+            return True
+        self.set_selection(added.union(self.selection))
+        return True
+
+    def remove_from_selection(self, geometries, remaining_geometries, transform=True):
+        """
+        Remove cells of the geometries from current selection. The selection is changed only within the removed
+        geometries window, where it is AND-ed with the mask of the remaining selecting geometries, so that the cells
+        on the removed geometries boundary are selected exactly as by a complete selection of the remaining geometries.
+        Return False if the geometries transformation failed.
+        """
+        sel = self.selection
+        if sel is None:
+            return True
+        if transform:
+            geometries = self.transform_geometries(geometries)
+            remaining_geometries = self.transform_geometries(remaining_geometries)
+            if geometries is None or remaining_geometries is None:
+                return False
+        removed_window = self.geometries_window(geometries)
+        if removed_window is None:
+            return True
+        # the part of the removed geometries window overlapping the selection block
+        row_min, col_min = max(removed_window[0], sel.row), max(removed_window[2], sel.col)
+        row_max, col_max = min(removed_window[1], sel.row_max), min(removed_window[3], sel.col_max)
+        if row_min > row_max or col_min > col_max:
+            return True
+        window = (row_min, row_max, col_min, col_max)
+        rows, cols = row_max - row_min + 1, col_max - col_min + 1
+        remaining = self.rasterize(remaining_geometries, window=window)
+        kept = None
+        if remaining is not None:
+            kept_mask = sel.window_mask(row_min, col_min, rows, cols) & \
+                remaining.window_mask(row_min, col_min, rows, cols)
+            kept = CellSelection.from_mask(kept_mask, row_min, col_min)
+        outside = sel.without_window(*window)
+        self.set_selection(outside.union(kept) if outside is not None else kept)
+        return True
+
+    def set_selection(self, selection):
+        """Set the selection (CellSelection or None)."""
+        self.selection_version += 1
+        self.selection = selection
+        if self.logger:
+            self.logger.debug(f"Nr of cells selected: {len(self.selection) if self.selection else 0}")
+
+    def selected_indices(self):
+        """Return arrays of global rows and columns of selected cells, sorted by rows and columns."""
+        return self.selection.indices()
+
+    def cell_centers_xy(self, rows, cols):
+        """Return arrays of x and y coordinates of cells centers for arrays of their rows and columns."""
+        return self.first_pixel_x + cols * self.pixel_size_x, self.first_pixel_y - rows * self.pixel_size_y
+
+    def create_cell_pts_layer(self, max_cells=None):
+        """
+        For current block extent, create memory point layer with a feature in each selected cell.
+        If max_cells is given, only the first max_cells cells are used, e.g. for expression preview.
+        The layer is created again only if the selection has changed since.
+        """
+        if self.cell_pts_layer is not None and self.cell_pts_key == (self.selection_version, max_cells):
+            return
+        self.cell_pts_key = (self.selection_version, max_cells)
         crs_str = self.layer.crs().authid().lower()
         fields_def = "field=row:int&field=col:int"
         self.cell_pts_layer = QgsVectorLayer(f"Point?crs={crs_str}&{fields_def}", "Temp raster cell points", "memory")
         fields = self.cell_pts_layer.dataProvider().fields()
         feats = []
-        for row_col, xy in self.cell_centers.items():
-            row, col = row_col
-            x, y = xy
+        for row, col in islice(self.selection.iter_cells() if self.selection else [], max_cells):
+            x, y = self.cell_centers_xy(row, col)
             feat = QgsFeature(fields)
             feat.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
             feat["row"] = row
             feat["col"] = col
             feats.append(feat)
         self.cell_pts_layer.dataProvider().addFeatures(feats)
-        self.selected_cells_feats = dict()  # {(row, cell): feat}
-        for feat in self.cell_pts_layer.getFeatures():
-            self.selected_cells_feats[(feat["row"], feat["col"])] = feat.id()
 
-    def write_block(self, const_values=None, low_pass_filter=False):
+    def write_block(self, const_values=None, raster_filter=None, exp_values=None, feedback=None):
         """
         Construct raster block for each band, apply the values and write to file.
         If const_values are given (a list of const values for each band) they are used for each selected cell.
-        In other case the memory layer with values calculated for each cell selected will be used.
-        Alternatively, selected cells values can be filtered using low-pass 3x3 filter.
+        In other case exp_values array, with expression value for each selected cell (in selected_indices order),
+        will be used.
+        Alternatively, selected cells values can be filtered using the raster_filter (a RasterFilter instance).
+        The block data is modified as NumPy array with a single masked assignment per band.
+        The block is processed in tiles of tile_size cells (if set) and tiles without selected cells are skipped.
+        If feedback (a QgsTask or QgsFeedback) is given, progress is reported for tiles processed and if it gets
+        canceled, the tiles already written are rolled back. The change is returned then, instead of emitting
+        raster_changed signal, so that it can be handled in the main thread.
+        If writing fails, the tiles already written are rolled back too, the error is set and None is returned.
         """
+        self.error = None
+        if self.selection is None:
+            return None
         if self.logger:
             vals = f"const values ({const_values})" if const_values else "expression values."
             self.logger.debug(f"Writing blocks with {vals}")
-        if not self.provider.isEditable():
-            res = self.provider.setEditable(True)
-            if not res:
-                if self.uc:
-                    self.uc.show_warn('QGIS can\'t modify this type of raster')
-                return None
-        if self.logger:
-            self.logger.debug("Calculating block origin coordinates...")
-        b_orig_x, b_orig_y = self.index_to_point(self.block_row_min, self.block_col_min)
-        cols = self.block_col_max - self.block_col_min + 1
-        rows = self.block_row_max - self.block_row_min + 1
-        b_end_x = b_orig_x + cols * self.pixel_size_x
-        b_end_y = b_orig_y - rows * self.pixel_size_y
-        block_bbox = QgsRectangle(b_orig_x, b_end_y, b_end_x, b_orig_y)
+        if not self.start_editing():
+            self.error = 'QGIS can\'t modify this type of raster'
+            if self.uc and feedback is None:
+                self.uc.show_warn(self.error)
+            return None
         if self.logger:
-            self.logger.debug(f"Block bbox: {block_bbox.toString()}")
+            rows, cols = self.selection.rows, self.selection.cols
             self.logger.debug(f"Nr of cells in the block: rows={rows}, cols={cols}")
-        old_blocks = []
-        new_blocks = []
-        cell_values = dict()
-        if const_values is None and not low_pass_filter:
-            for feat in self.cell_pts_layer.getFeatures():
-                cell_values[feat.id()] = feat.attribute(self.exp_field_idx)
-        for band_nr in self.active_bands:
-            block = self.provider.block(band_nr, block_bbox, cols, rows)
-            new_blocks.append(block)
-            block_data = block.data().data()
-            old_block = QgsRasterBlock(self.data_types[band_nr - 1], cols, rows)
-            old_block.setData(block_data)
-            for abs_row, abs_col in self.selected_cells:
-                row = abs_row - self.block_row_min
-                col = abs_col - self.block_col_min
-                if const_values:
-                    idx = band_nr - 1 if len(self.active_bands) > 1 else 0
-                    new_val = const_values[idx]
-                elif low_pass_filter:
-                    # the filter is applied for cells inside the block only
-                    if block.height() < 3 or block.width() < 3:
-                        # the selected block is too small for filtering -> keep the old value
-                        new_val = None
+        if exp_values is not None:
+            cell_rows, cell_cols = self.selected_indices()
+        halo = raster_filter.radius if raster_filter else 0
+        change = RasterChange(self.active_bands)
+        tiles = list(self.block_tiles())
+        try:
+            for tile_nr, (row, col, tile_mask) in enumerate(tiles):
+                if feedback is not None:
+                    if feedback.isCanceled():
+                        self.write_block_undo(change.get_undo())
+                        return None
+                    feedback.setProgress(100. * tile_nr / len(tiles))
+                rows, cols = tile_mask.shape
+                if exp_values is not None:
+                    tile_values = self.tile_values(cell_rows, cell_cols, exp_values, row, col, rows, cols)
+                    exp_mask = tile_mask & ~numpy.isnan(tile_values)
+                old_arrays = []
+                new_arrays = []
+                arrays, window = self.read_tile(self.active_bands, row, col, rows, cols, halo=halo)
+                for band_nr, array in zip(self.active_bands, arrays):
+                    old_array = array[window].copy()
+                    new_array = old_array.copy()
+                    if const_values:
+                        idx = band_nr - 1 if len(self.active_bands) > 1 else 0
+                        if const_values[idx] is not None:
+                            new_array[tile_mask] = const_values[idx]
+                    elif raster_filter:
+                        # neighboring tiles could be already modified - filter the original values
+                        change.restore_old_values(band_nr, array, row - window[0].start, col - window[1].start)
+                        filtered = raster_filter.apply(array, self.nodata_values[band_nr - 1])[window]
+                        new_array[tile_mask] = filtered[tile_mask]
                     else:
-                        new_val = low_pass_filtered(old_block, row, col, self.nodata_values[band_nr - 1])
-                else:
-                    # set the expression value
-                    feat_id = self.selected_cells_feats[(abs_row, abs_col)]
-                    if cell_values[feat_id] is not None:
-                        new_val = None if math.isnan(cell_values[feat_id]) or \
-                                      cell_values[feat_id] is None else cell_values[feat_id]
-                    else:
-                        new_val = None
-                new_val = old_block.value(row, col) if new_val is None else new_val
-                set_res = block.setValue(row, col, new_val)
+                        # set the expression values, cells with invalid values keep the old value
+                        new_array[exp_mask] = tile_values[exp_mask]
+                    old_arrays.append(old_array)
+                    new_arrays.append(new_array)
+                # the tile is added to the change before writing, so that a partially written tile is rolled back too
+                change.add_tile(row, col, old_arrays, new_arrays)
+                res = self.write_bands(new_arrays, self.active_bands, row, col)
                 if self.logger:
-                    self.logger.debug(f"Setting block value for band {band_nr}, row {row}, col: {col}: {set_res}")
-            old_blocks.append(old_block)
-            band_res = self.provider.writeBlock(block, band_nr, self.block_col_min, self.block_row_min)
-            if self.logger:
-                self.logger.debug(f"Writing block for band {band_nr}: {band_res}")
-        self.provider.setEditable(False)
-        change = RasterChange(self.active_bands, self.block_row_min, self.block_col_min, old_blocks, new_blocks)
-        self.raster_changed.emit(change)
-        return True
+                    self.logger.debug(f"Writing tile ({row}, {col}) block for bands {self.active_bands}: {res}")
+        except Exception as err:
+            # roll back the tiles already written and leave the editing mode, so the raster is not left half modified
+            self.error = repr(err)
+            try:
+                self.write_block_undo(change.get_undo())
+            except Exception as undo_err:
+                self.error += f", rolling back failed: {undo_err!r}"
+            finally:
+                self.stop_editing()
+            if self.uc and feedback is None:
+                self.uc.show_warn(f"Writing raster failed: {self.error}")
+            return None
+        self.stop_editing()
+        if feedback is None:
+            self.raster_changed.emit(change)
+        return change
+
+    def write_cells(self, rows, cols, values, change=None):
+        """
+        Write values (list of values for bands, None keeps the band unchanged) to cells given as arrays of their global
+        rows and columns, without any selection. Only the bounding block of the cells is read and written, so that it is
+        fast enough for interactive drawing. Cells outside the raster are ignored. Within a stroke (see start_stroke),
+        the data provider stays in editing mode after writing.
+        The modified cells are added to the change (RasterChange), if given, e.g. to collect a stroke as a single undo
+        step. Return the change, or None if nothing was written.
+        """
+        self.error = None
+        inside = (rows >= 0) & (rows < self.raster_rows) & (cols >= 0) & (cols < self.raster_cols)
+        if not inside.any():
+            return None
+        rows, cols = rows[inside], cols[inside]
+        if not self.start_editing():
+            self.error = 'QGIS can\'t modify this type of raster'
+            return None
+        if change is None:
+            change = RasterChange(self.active_bands)
+        for in_tile, row, col, nr_rows, nr_cols in self.cell_blocks(rows, cols):
+            tile_rows, tile_cols = rows[in_tile], cols[in_tile]
+            arrays = self.read_bands(self.active_bands, row, col, nr_rows, nr_cols)
+            old_arrays = [array.copy() for array in arrays]
+            for band_nr, array in zip(self.active_bands, arrays):
+                value = values[band_nr - 1 if len(self.active_bands) > 1 else 0]
+                if value is not None:
+                    array[tile_rows - row, tile_cols - col] = value
+            self.write_bands(arrays, self.active_bands, row, col)
+            change.add_tile(row, col, old_arrays, arrays)
+        if not self.stroke_editing:
+            self.stop_editing()
+        return change
+
+    def cell_blocks(self, rows, cols):
+        """
+        Split cells given as arrays of their rows and columns by tiles of CELLS_TILE size, so that cells spread over
+        the raster, e.g. along a long stroke, are read and written in small blocks. Yield (cells indices, row, col,
+        rows, cols) for each tile with the cells, with bounding block of the tile cells.
+        """
+        size = self.CELLS_TILE
+        tile_keys = rows // size * (self.raster_cols // size + 1) + cols // size
+        order = numpy.argsort(tile_keys, kind="stable")
+        for in_tile in numpy.split(order, numpy.flatnonzero(numpy.diff(tile_keys[order])) + 1):
+            tile_rows, tile_cols = rows[in_tile], cols[in_tile]
+            row, col = int(tile_rows.min()), int(tile_cols.min())
+            yield in_tile, row, col, int(tile_rows.max()) - row + 1, int(tile_cols.max()) - col + 1
+
+    def read_cells(self, band_nr, rows, cols):
+        """
+        Return array of band values of cells given as arrays of their rows and columns (inside the raster). Only
+        bounding blocks of the cells within tiles of CELLS_TILE size are read, so memory use doesn't depend on the
+        cells bounding box, e.g. for thin diagonal selections.
+        """
+        values = None
+        for in_tile, row, col, nr_rows, nr_cols in self.cell_blocks(rows, cols):
+            array = self.read_array(band_nr, row, col, nr_rows, nr_cols)
+            if values is None:
+                values = numpy.empty(rows.shape, dtype=array.dtype)
+            values[in_tile] = array[rows[in_tile] - row, cols[in_tile] - col]
+        return values if values is not None else numpy.empty(0)
 
     def write_block_undo(self, data):
         """Write blocks from the undo / redo stack."""
         if self.logger:
             self.logger.debug(f"Writing blocks from undo")
-        if not self.provider.isEditable():
-            res = self.provider.setEditable(True)
-        bands, row_min, col_min, blocks = data
-        for band_nr in bands:
-            idx = band_nr - 1 if len(bands) > 1 else 0
-            block = blocks[idx]
-            band_res = self.provider.writeBlock(block, band_nr, col_min, row_min)
+        self.start_editing()
+        bands, tiles = data
+        for row, col, rows, cols, band_cells in tiles:
+            # rebuild the tile blocks from current data and the stored cell values
+            arrays = self.read_bands(bands, row, col, rows, cols)
+            for array, (indices, values) in zip(arrays, band_cells):
+                array.reshape(-1)[indices] = values
+            res = self.write_bands(arrays, bands, row, col)
+            if self.logger:
+                self.logger.debug(f"Writing undo/redo tile ({row}, {col}) block for bands {bands}: {res}")
+        self.stop_editing()
+
+    def start_editing(self):
+        """
+        Make the raster writable, unless the GDAL backend or edit session is used.
+        Return False if the raster can't be modified.
+        """
+        if self.overlay is not None or self.backend is not None or self.provider.isEditable():
+            return True
+        return self.provider.setEditable(True)
+
+    def stop_editing(self):
+        """Finish writing - switch the data provider back to read-only mode, or flush the GDAL backend."""
+        if self.overlay is not None:
+            return
+        if self.backend is None:
+            self.provider.setEditable(False)
+        elif self.backend.flush():
+            self.reload_needed = True
+
+    def start_stroke(self):
+        """
+        Keep the data provider in editing mode while cells of a drawing stroke are written, instead of switching it
+        (and reopening the raster) for each written frame. The GDAL backend is still flushed after each write, so that
+        the changes are rendered.
+        """
+        if self.backend is None and self.overlay is None and self.start_editing():
+            self.stroke_editing = True
+
+    def finish_stroke(self):
+        """Switch the data provider back to read-only mode after a drawing stroke."""
+        if self.stroke_editing:
+            self.stroke_editing = False
+            self.stop_editing()
+
+    def start_session(self):
+        """
+        Start edit session - modifications are kept in memory overlay, rendered through the layer pipe, until they are
+        committed to the raster.
+        """
+        if self.overlay is not None:
+            return
+        self.overlay = EditOverlay(self.VALUE_CACHE_TILE)
+        geo = (self.origin_x, self.origin_y, self.pixel_size_x, self.pixel_size_y)
+        self.overlay_interface = OverlayRasterInterface(self.overlay, geo)
+        if not self.layer.pipe().insert(1, self.overlay_interface):
+            self.overlay_interface = None
             if self.logger:
-                self.logger.debug(f"Writing undo/redo block for band {band_nr}: {band_res}")
-        self.provider.setEditable(False)
+                self.logger.debug("Inserting edit overlay into the raster pipe failed")
+
+    def commit_session(self):
+        """
+        Write modified tiles of the edit session to the raster in one pass. Return True if anything was written.
+        If writing fails, the error is set and the modifications are kept in the overlay, so that the commit can be
+        repeated.
+        """
+        self.error = None
+        if self.overlay is None or self.overlay.is_empty():
+            return False
+        overlay = self.overlay
+        self.overlay = None
+        try:
+            if not self.start_editing():
+                self.error = 'QGIS can\'t modify this type of raster'
+                return False
+            for (row, col), band_tiles in sorted(overlay.dirty_tiles().items()):
+                bands = sorted(band_tiles)
+                if self.write_bands([band_tiles[band_nr] for band_nr in bands], bands, row, col) is False:
+                    raise IOError(f"writing tile ({row}, {col}) failed")
+            self.stop_editing()
+            overlay.clear()
+        except Exception as err:
+            self.error = repr(err)
+            try:
+                self.stop_editing()
+            except Exception:
+                pass
+            return False
+        finally:
+            self.overlay = overlay
+        return True
+
+    def end_session(self):
+        """
+        Commit the edit session modifications and stop buffering them. Return False if the commit failed - the
+        session goes on then, with the modifications kept in memory, and the error is set.
+        """
+        if self.overlay is None:
+            return True
+        self.commit_session()
+        if self.error:
+            return False
+        if self.overlay_interface is not None:
+            self.layer.pipe().remove(self.overlay_interface)
+            self.overlay_interface = None
+        self.overlay = None
+        self.refresh_layer()
+        return True
+
+    def close(self):
+        """
+        Commit the edit session and release the GDAL backend - the handler must not be used for writing anymore.
+        Return False if committing the session failed - nothing is released then and the error is set.
+        """
+        self.finish_stroke()
+        if not self.end_session():
+            return False
+        if self.backend is not None:
+            if self.backend.close():
+                self.reload_needed = True
+            self.backend = None
+            self.refresh_layer()
+        return True
+
+    def has_uncommitted_edits(self):
+        return self.overlay is not None and not self.overlay.is_empty()
+
+    def refresh_layer(self):
+        """Repaint the layer after modification, reloading its data provider if written by the GDAL backend."""
+        if self.reload_needed:
+            self.reload_needed = False
+            self.layer.reload()
+        self.layer.triggerRepaint()
+
+    def block_tiles(self):
+        """
+        Yield tiles of the selected block as (row, col, tile_mask) with global indices of the tile upper left cell and
+        the part of selection mask for the tile. Only tiles with selected cells are yielded.
+        If tile_size is not set, the whole block is a single tile, unless the selection is sparse.
+        """
+        sel = self.selection
+        if self.tile_size > 0:
+            size = self.tile_size
+        elif sel.count < sel.rows * sel.cols * self.SPARSE_FILL:
+            # e.g. a thin line across the raster - only tiles touched by the selection are read and written
+            size = self.SPARSE_TILE
+        else:
+            size = max(sel.rows, sel.cols)
+        for row, col in sel.tiles(size):
+            rows, cols = min(size, sel.row_max + 1 - row), min(size, sel.col_max + 1 - col)
+            yield row, col, sel.window_mask(row, col, rows, cols)
+
+    def read_tile(self, bands, row, col, rows, cols, halo=0):
+        """
+        Read bands tile of rows x cols cells with upper left cell at (row, col) extended by a halo of cells on each
+        side, as far as the raster extent allows. Return list of bands arrays and the window of the tile within the
+        arrays.
+        """
+        halo_row_min = max(0, row - halo)
+        halo_col_min = max(0, col - halo)
+        halo_rows = min(self.raster_rows, row + rows + halo) - halo_row_min
+        halo_cols = min(self.raster_cols, col + cols + halo) - halo_col_min
+        arrays = self.read_bands(bands, halo_row_min, halo_col_min, halo_rows, halo_cols)
+        window = (slice(row - halo_row_min, row - halo_row_min + rows),
+                  slice(col - halo_col_min, col - halo_col_min + cols))
+        return arrays, window
+
+    @staticmethod
+    def tile_values(cell_rows, cell_cols, values, row, col, rows, cols):
+        """
+        Return values array of the tile with upper left cell at (row, col) for cells given as sorted arrays of their
+        rows, columns and values. Cells without a value get nan.
+        """
+        tile_values = numpy.full((rows, cols), numpy.nan)
+        start, end = numpy.searchsorted(cell_rows, [row, row + rows])
+        t_rows = cell_rows[start:end] - row
+        t_cols = cell_cols[start:end] - col
+        inside = (t_cols >= 0) & (t_cols < cols)
+        tile_values[t_rows[inside], t_cols[inside]] = values[start:end][inside]
+        return tile_values
+
+    def block_extent(self, row, col, rows, cols):
+        """Return extent of the block of rows x cols cells with upper left cell at (row, col)."""
+        x_min, y_max = self.index_to_point(row, col)
+        return QgsRectangle(x_min, y_max - rows * self.pixel_size_y, x_min + cols * self.pixel_size_x, y_max)
+
+    def read_array(self, band_nr, row, col, rows, cols):
+        """
+        Read band block of rows x cols cells with upper left cell at (row, col) as NumPy array.
+        In edit session, cells modified and not committed yet are read from the overlay.
+        """
+        array = self.read_source_array(band_nr, row, col, rows, cols)
+        if self.overlay is not None:
+            self.overlay.patch(band_nr, array, row, col)
+        return array
+
+    def write_array(self, array, band_nr, row, col):
+        """Write the array as band block with upper left cell at (row, col). In edit session, write to the overlay."""
+        self.invalidate_value_cache(band_nr, row, col, *array.shape)
+        if self.overlay is not None:
+            self.overlay.write(band_nr, array, row, col, self.read_overlay_tile)
+            return True
+        return self.write_source_array(array, band_nr, row, col)
+
+    def read_source_array(self, band_nr, row, col, rows, cols):
+        """Read band block from the raster data source, ignoring the edit session overlay."""
+        if self.backend is not None:
+            return self.backend.read_array(band_nr, row, col, rows, cols)
+        block = self.provider.block(band_nr, self.block_extent(row, col, rows, cols), cols, rows)
+        return block_to_array(block)
+
+    def write_source_array(self, array, band_nr, row, col):
+        """Write band block to the raster data source."""
+        if self.backend is not None:
+            return self.backend.write_array(array, band_nr, row, col)
+        block = array_to_block(array, self.data_types[band_nr - 1])
+        return self.provider.writeBlock(block, band_nr, col, row)
+
+    def read_overlay_tile(self, band_nr, tile_row, tile_col):
+        """Read band tile of the edit session overlay from the data source."""
+        size = self.overlay.tile_size
+        return self.read_source_array(band_nr, tile_row, tile_col, min(size, self.raster_rows - tile_row),
+                                      min(size, self.raster_cols - tile_col))
+
+    def read_bands(self, bands, row, col, rows, cols):
+        """
+        Read blocks of the bands of rows x cols cells with upper left cell at (row, col) as list of NumPy arrays.
+        With the GDAL backend, all the bands are read at once, if they have the same data type.
+        """
+        if self.backend is not None and len(bands) > 1:
+            arrays = self.backend.read_bands(bands, row, col, rows, cols)
+            if arrays is not None:
+                if self.overlay is not None:
+                    for band_nr, array in zip(bands, arrays):
+                        self.overlay.patch(band_nr, array, row, col)
+                return list(arrays)
+        return [self.read_array(band_nr, row, col, rows, cols) for band_nr in bands]
+
+    def write_bands(self, arrays, bands, row, col):
+        """
+        Write arrays of the bands as blocks with upper left cell at (row, col). Return True on success.
+        With the GDAL backend, all the bands are written at once, if they have the same data type.
+        """
+        if self.backend is not None and self.overlay is None and len(bands) > 1:
+            for band_nr, array in zip(bands, arrays):
+                self.invalidate_value_cache(band_nr, row, col, *array.shape)
+            res = self.backend.write_bands(arrays, bands, row, col)
+            if res is not None:
+                return res
+        return all([self.write_array(array, band_nr, row, col) for band_nr, array in zip(bands, arrays)])
+
+    def cell_value(self, band_nr, row, col):
+        """
+        Return value of the band cell, or None for NoData cell. The value is looked up in the cache of raster tiles,
+        reading the tile from the raster if not cached yet.
+        """
+        size = self.VALUE_CACHE_TILE
+        key = (band_nr, row // size * size, col // size * size)
+        with self.value_cache_lock:
+            if key in self.value_cache:
+                self.value_cache.move_to_end(key)
+                array = self.value_cache[key]
+            else:
+                _, tile_row, tile_col = key
+                array = self.read_array(band_nr, tile_row, tile_col, min(size, self.raster_rows - tile_row),
+                                        min(size, self.raster_cols - tile_col))
+                self.value_cache[key] = array
+                if len(self.value_cache) > self.VALUE_CACHE_TILES:
+                    self.value_cache.popitem(last=False)
+        value = array[row - key[1], col - key[2]]
+        if nodata_mask(value, self.nodata_values[band_nr - 1]):
+            return None
+        return value.item()
+
+    def point_values(self, point, bands=None):
+        """Return list of bands (all by default) values of the cell at the point (in raster CRS), using tiles cache."""
+        col, row = self.point_to_index([point.x(), point.y()])
+        row = min(max(row, 0), self.raster_rows - 1)
+        col = min(max(col, 0), self.raster_cols - 1)
+        return [self.cell_value(band_nr, row, col) for band_nr in (bands if bands else self.bands_range)]
+
+    def invalidate_value_cache(self, band_nr, row, col, rows, cols):
+        """Drop cached tiles of the band overlapping the block of rows x cols cells with upper left cell (row, col)."""
+        size = self.VALUE_CACHE_TILE
+        with self.value_cache_lock:
+            for key in list(self.value_cache):
+                tile_band, tile_row, tile_col = key
+                if tile_band == band_nr and tile_row < row + rows and row < tile_row + size and \
+                        tile_col < col + cols and col < tile_col + size:
+                    del self.value_cache[key]
 
     def extent_to_cell_indices(self, extent):
         """Return x and y raster cell indices ranges for the extent."""
@@ -288,6 +803,10 @@ class RasterHandler(QObject):
             self.logger.debug(f"Coords for ({row}, {col}) = ({x}, {y}) (x, y)")
         return x, y
 
+    def point_to_cell(self, x, y):
+        """Return (row, col) indices of the cell at the coordinates, which may be outside of the raster."""
+        return math.floor((self.origin_y - y) / self.pixel_size_y), math.floor((x - self.origin_x) / self.pixel_size_x)
+
     def point_to_index(self, coords):
         """
         Return raster cell indices for the coordinates.
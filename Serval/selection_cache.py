@@ -0,0 +1,47 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class SelectionCache(object):
+    """
+    Cache of raster cells selections, keyed by a fingerprint of the selecting geometries, the all touched cells rule
+    and the raster grid, so that repeated operations on unchanged selection don't rasterize the geometries again.
+    The cache is shared by raster handlers - rasters with identical grids share the selections, too.
+    """
+
+    MAX_ENTRIES = 4
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # {fingerprint: selection state}, least recently used first
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(geometries, all_touched, grid):
+        """Return fingerprint of the selecting geometries (in raster CRS) selecting cells of the grid."""
+        digest = hashlib.sha1()
+        for geom in geometries:
+            digest.update(bytes(geom.asWkb()))
+            digest.update(b"|")
+        digest.update(repr((all_touched, grid)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return cached selection state for the fingerprint, or None."""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, state):
+        with self.lock:
+            self.entries[key] = state
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -1,7 +1,15 @@
-from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtCore import Qt, pyqtSignal
 from qgis.PyQt.QtGui import QPixmap, QCursor, QColor
 from qgis.PyQt.QtWidgets import QApplication
-from qgis.core import QgsWkbTypes, QgsGeometry
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsProject,
+    QgsRectangle,
+    QgsWkbTypes,
+)
 from qgis.gui import QgsMapTool, QgsRubberBand
 
 from .utils import icon_path, get_logger
@@ -18,6 +26,9 @@ class RasterCellSelectionMapTool(QgsMapTool):
     LINE_SELECTION = "line"
     POLYGON_SELECTION = "polygon"
 
+    # emitted with the selection mode and the geometries added to, removed from or replacing the selection
+    selection_changed = pyqtSignal(str, object)
+
     def __init__(self, iface, uc, raster, debug=False):
         super(RasterCellSelectionMapTool, self).__init__(iface.mapCanvas())
         self.iface = iface
@@ -77,6 +88,7 @@ class RasterCellSelectionMapTool(QgsMapTool):
         self.raster = None
         self.current_points = None
         self.selected_geometries = None
+        self.selection_changed.emit(self.NEW_SELECTION, [])
 
     def selecting_finished(self):
         if self.logger:
@@ -107,6 +119,7 @@ class RasterCellSelectionMapTool(QgsMapTool):
         self.current_selection_reset()
         self.selected_rubber_reset()
         self.selected_geometries = None
+        self.selection_changed.emit(self.NEW_SELECTION, [])
 
     def create_selecting_geometry(self, cur_position=None):
         pt = [cur_position] if cur_position else []
@@ -202,23 +215,86 @@ class RasterCellSelectionMapTool(QgsMapTool):
                     continue
                 new_geoms.append(geom)
             self.selected_geometries = new_geoms
+        self.selection_changed.emit(self.selection_mode, [new_geom])
         self.selected_rubber_update()
         self.current_selection_reset()
         self.uc.bar_info("Selection created")
 
-    def selection_from_layer(self, layer):
+    def selection_from_layer(self, layer, simplify=False):
+        """
+        Create a new selection from the layer (selected) features. Only features within the raster extent (grown by
+        the buffer of point and line geometries) are read and features with invalid geometry are skipped. Geometries
+        are transformed to the project CRS and merged into a single selecting geometry - point and line geometries are
+        buffered as one collection, polygons are united. If simplify is True, the geometry is simplified with tolerance
+        of half of the raster pixel size, unless the simplified geometry is invalid.
+        """
         if self.logger:
             self.logger.debug(f"Selection from layer: {layer.name()}")
-        sel_geoms = []
-        features = layer.getSelectedFeatures() if layer.selectedFeatureCount() else layer.getFeatures()
-        for feat in features:
-            if layer.geometryType() == QgsWkbTypes.LineGeometry or layer.geometryType() == QgsWkbTypes.PointGeometry:
-                geom = feat.geometry().buffer(self.sel_line_width / 2., 5)
-            else:
-                geom = feat.geometry()
-            if geom.isGeosValid():
-                sel_geoms.append(geom)
-        self.selected_geometries = sel_geoms
+        project = QgsProject.instance()
+        buffered = layer.geometryType() == QgsWkbTypes.LineGeometry or \
+            layer.geometryType() == QgsWkbTypes.PointGeometry
+        request = QgsFeatureRequest().setNoAttributes()
+        if self.raster is not None:
+            to_project = QgsCoordinateTransform(self.raster.crs(), project.crs(), project)
+            to_layer = QgsCoordinateTransform(project.crs(), layer.crs(), project)
+            try:
+                # features just outside the raster can reach into it with their buffer (in project units)
+                extent = to_project.transformBoundingBox(self.raster.extent())
+                if buffered:
+                    extent.grow(self.sel_line_width / 2.)
+                request.setFilterRect(to_layer.transformBoundingBox(extent))
+            except QgsCsException:
+                pass
+        features = layer.getSelectedFeatures(request) if layer.selectedFeatureCount() else layer.getFeatures(request)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        geoms = [feat.geometry() for feat in features if feat.hasGeometry()]
+        valid_geoms = [geom for geom in geoms if geom.isGeosValid()]
+        if not valid_geoms:
+            QApplication.restoreOverrideCursor()
+            self.uc.bar_warn("No valid features within the raster extent")
+            return
+        if len(valid_geoms) < len(geoms):
+            self.uc.bar_warn(f"{len(geoms) - len(valid_geoms)} features with invalid geometry skipped", dur=3)
+        geoms = valid_geoms
+        if buffered:
+            geom = QgsGeometry.collectGeometry(geoms)
+        else:
+            geom = QgsGeometry.unaryUnion(geoms)
+        to_project = QgsCoordinateTransform(layer.crs(), project.crs(), project)
+        if not to_project.isShortCircuited():
+            try:
+                geom.transform(to_project)
+            except QgsCsException:
+                QApplication.restoreOverrideCursor()
+                self.uc.bar_warn("Layer geometries transformation failed! Check the layer projection.")
+                return
+        if buffered:
+            geom = geom.buffer(self.sel_line_width / 2., 5)
+        if simplify and self.raster is not None:
+            simplified = geom.simplify(self.pixel_size(project) / 2.)
+            # simplification may produce self-intersecting polygons - use the original geometry then
+            if not simplified.isEmpty() and simplified.isGeosValid():
+                geom = simplified
+        QApplication.restoreOverrideCursor()
+        if geom.isEmpty() or not geom.isGeosValid():
+            self.uc.bar_warn("Selection geometry from layer is invalid")
+            return
+        self.selected_geometries = [geom]
+        self.selection_changed.emit(self.NEW_SELECTION, self.selected_geometries)
         self.selected_rubber_update()
         self.current_selection_reset()
         self.uc.bar_info("Selection loaded")
+
+    def pixel_size(self, project):
+        """Return raster pixel size in project CRS units."""
+        size = min(self.raster.rasterUnitsPerPixelX(), self.raster.rasterUnitsPerPixelY())
+        to_project = QgsCoordinateTransform(self.raster.crs(), project.crs(), project)
+        if to_project.isShortCircuited():
+            return size
+        center = self.raster.extent().center()
+        pixel = QgsRectangle(center.x(), center.y(), center.x() + size, center.y() + size)
+        try:
+            pixel = to_project.transformBoundingBox(pixel)
+        except QgsCsException:
+            return 0.
+        return min(pixel.width(), pixel.height())
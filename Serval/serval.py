@@ -17,39 +17,41 @@
  ***************************************************************************/
 """
 
+import hashlib
 import math
 import os.path
-from datetime import datetime, timedelta
+import threading
 
-from qgis.PyQt.QtCore import QSize, Qt, QUrl, QVariant, QSettings
+import numpy
+
+from qgis.PyQt.QtCore import QSize, Qt, QTimer, QUrl, QSettings
 from qgis.PyQt.QtGui import QPixmap, QCursor, QIcon, QColor, QDesktopServices
 from qgis.PyQt.QtWidgets import (
     QAction,
-    QApplication,
     QComboBox,
     QInputDialog,
     QLabel,
     QLineEdit,
 )
 from qgis.core import (
+    QgsApplication,
     QgsCoordinateTransform,
     QgsCsException,
     QgsExpression,
     QgsFeature,
-    QgsField,
     QgsGeometry,
     QgsMapLayerType,
     QgsMeshDatasetIndex,
     QgsPointXY,
     QgsProject,
-    QgsRaster,
     QgsRectangle,
-    QgsSpatialIndex,
     QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
 )
 from qgis.gui import (QgsDoubleSpinBox, QgsMapToolEmitPoint, QgsColorButton, QgsExpressionBuilderDialog, )
 
 from .raster_handler import RasterHandler
+from .selection_cache import SelectionCache
 from .selection_tool import RasterCellSelectionMapTool
 from .serval_exp_functions import (
     interpolate_from_mesh,
@@ -58,9 +60,18 @@ from .serval_exp_functions import (
     nearest_pt_on_line_interpolate_z,
 )
 from .band_spin_boxes import BandBoxes
+from .cell_selection import CellSelection
+from .draw_tool import RasterBrushMapTool, RasterDrawMapTool
+from .edit_task import RasterEditTask
+from .exp_evaluator import CellExpressionEvaluator
+from .filters import RasterFilter
+from .layer_cache import FeatureCache, SpatialIndexCache
 from .layer_select_dlg import LayerSelectDialog
-from .raster_changes import RasterChanges
-from .utils import is_number, icon_path, dtypes, get_logger, check_gdal_driver_create_option
+from .mesh_sampler import MeshSamplerCache
+from .raster_changes import ChangeJournal, RasterChange, RasterChanges
+from .settings_dlg import SettingsDialog
+from .utils import is_number, icon_path, dtypes, get_logger, check_gdal_driver_create_option, line_cells, \
+    brush_rows, nodata_mask
 from .user_communication import UserCommunication
 
 DEBUG = False
@@ -72,6 +83,7 @@ class Serval(object):
     POLYGON_SELECTION = "polygon"
     RGB = "RGB"
     SINGLE_BAND = "Single band"
+    EXP_PREVIEW_CELLS = 100
 
     def __init__(self, iface):
         self.iface = iface
@@ -89,13 +101,32 @@ class Serval(object):
         self.last_point = QgsPointXY(0, 0)
         self.rbounds = None
         self.changes = dict()  # dict with rasters changes {raster_id: RasterChanges instance}
+        self.edit_tasks = []  # running (the first one) and queued raster edit tasks
+        self.unclosed_handlers = []  # handlers of inactive rasters, which failed to commit their buffered edits
         self.project = QgsProject.instance()
         self.crs_transform = None
         self.all_touched = None
         self.selection_mode = None
-        self.spatial_index_time = dict()  # {layer_id: creation time}
-        self.spatial_index = dict()  # {layer_id: spatial index}
+        self.exp_lock = threading.RLock()  # lock for objects shared by expression evaluation threads
+        self.thread_data = threading.local()  # expression worker thread data, i.e. layers snapshots
         self.selection_layers_count = 1
+        self.selection_synced = False  # handler selection mask matches the selection tool geometries
+        self.index_cache = SpatialIndexCache(max_bytes=self.settings["index_memory"] * 1024 ** 2)
+        self.feature_cache = FeatureCache(max_bytes=self.settings["features_memory"] * 1024 ** 2)
+        self.mesh_cache = MeshSamplerCache(max_bytes=self.settings["index_memory"] * 1024 ** 2)
+        self.selection_cache = SelectionCache()
+        self.stroke_change = None  # RasterChange collecting cells drawn in current stroke
+        self.stroke_values = None  # bands values drawn in current stroke
+        self.stroke_cell = None  # the last (row, col) drawn in current stroke
+        self.stroke_cells = []  # (rows, cols) arrays of stroke cells not written yet
+        self.stroke_brush = None  # brush rows of current stroke (see utils.brush_rows), None for single cell pencil
+        self.stroke_timer = QTimer()  # writing stroke cells and repainting the raster, at most once per frame
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.setInterval(40)
+        self.stroke_timer.timeout.connect(self.write_stroke_cells)
+        self.autosave_timer = QTimer()
+        self.autosave_timer.timeout.connect(self.autosave_edits)
+        self.set_autosave_timer()
         self.debug = DEBUG
         self.logger = get_logger() if self.debug else None
 
@@ -115,12 +146,19 @@ class Serval(object):
         self.probe_tool.setObjectName('ServalProbeTool')
         self.probe_tool.setCursor(QCursor(QPixmap(icon_path('probe_tool.svg')), hotX=2, hotY=22))
         self.probe_tool.canvasClicked.connect(self.point_clicked)
-        self.draw_tool = QgsMapToolEmitPoint(self.canvas)
+        self.draw_tool = RasterDrawMapTool(self.canvas)
         self.draw_tool.setObjectName('ServalDrawTool')
-        self.draw_tool.setCursor(QCursor(QPixmap(icon_path('draw_tool.svg')), hotX=2, hotY=22))
-        self.draw_tool.canvasClicked.connect(self.point_clicked)
+        self.draw_tool.stroke_started.connect(self.start_stroke)
+        self.draw_tool.segment_drawn.connect(self.draw_segment)
+        self.draw_tool.stroke_finished.connect(self.finish_stroke)
+        self.brush_tool = RasterBrushMapTool(self.canvas)
+        self.brush_tool.setObjectName('ServalBrushTool')
+        self.brush_tool.stroke_started.connect(self.start_stroke)
+        self.brush_tool.segment_drawn.connect(self.draw_segment)
+        self.brush_tool.stroke_finished.connect(self.finish_stroke)
         self.selection_tool = RasterCellSelectionMapTool(self.iface, self.uc, self.raster, debug=self.debug)
         self.selection_tool.setObjectName('RasterSelectionTool')
+        self.selection_tool.selection_changed.connect(self.update_raster_selection)
         self.map_tool_btn = dict()  # {map tool: button activating the tool}
 
         self.iface.currentLayerChanged.connect(self.set_active_raster)
@@ -132,7 +170,44 @@ class Serval(object):
     def load_settings(self):
         """Return plugin settings dict - default values are overriden by user prefered values from QSettings."""
         self.default_settings = {
-            "undo_steps": {"value": 3, "vtype": int},
+            "undo_steps": {"value": 20, "vtype": int, "label": "Nr of Undo/Redo steps"},
+            "undo_memory": {"value": 256, "vtype": int, "label": "Undo/Redo memory limit (MB)",
+                            "tooltip": "The oldest changes are forgotten when their size exceeds the limit"},
+            "index_memory": {"value": 256, "vtype": int, "label": "Spatial indexes memory limit (MB)",
+                             "tooltip": "Spatial indexes of vector layers and triangulated meshes used by Serval "
+                                        "expression functions are kept until the layer changes or their size "
+                                        "exceeds the limit"},
+            "features_memory": {"value": 256, "vtype": int, "label": "Cached features memory limit (MB)",
+                                "tooltip": "Geometries and attributes of vector layers features used by Serval "
+                                           "expression functions are kept until the layer changes or their size "
+                                           "exceeds the limit"},
+            "undo_journal": {"value": False, "vtype": bool, "label": "Keep Undo/Redo history in journal file",
+                             "tooltip": "Changes are stored on disk and restored after QGIS restart or crash"},
+            "journal_steps": {"value": 500, "vtype": int, "label": "Nr of Undo/Redo steps in journal"},
+            "journal_dir": {"value": "", "vtype": str, "label": "Journal files directory",
+                            "tooltip": "Leave empty to use Serval directory in QGIS user profile"},
+            "filter_kernel": {"value": RasterFilter.MEAN, "vtype": str, "label": "Low-pass filter kernel",
+                              "options": RasterFilter.KERNEL_TYPES},
+            "filter_size": {"value": 3, "vtype": int, "label": "Filter kernel size (cells)", "min": 3, "max": 99,
+                            "tooltip": "Even sizes are rounded up to the nearest odd size"},
+            "filter_weights": {"value": "1 2 1 2 4 2 1 2 1", "vtype": str, "label": "Custom filter kernel weights",
+                               "tooltip": "Row by row weights of a square kernel with odd size, separated by spaces"},
+            "exp_threads": {"value": 1, "vtype": int, "label": "Expression evaluation threads", "min": 1, "max": 64,
+                            "tooltip": "Number of threads evaluating expression values concurrently"},
+            "gdal_backend": {"value": False, "vtype": bool, "label": "Write rasters directly with GDAL",
+                             "tooltip": "Keep the raster open for writing with GDAL instead of switching QGIS data "
+                                        "provider to editing mode for each edit - faster for large compressed rasters"},
+            "edit_session": {"value": False, "vtype": bool, "label": "Buffer edits in memory until committed",
+                             "tooltip": "Modified cells are kept in memory and written to the raster when committed, "
+                                        "automatically or when another raster gets active"},
+            "autosave_interval": {"value": 60, "vtype": int, "label": "Buffered edits autosave interval (s)",
+                                  "max": 86400, "tooltip": "Use 0 to commit buffered edits only explicitly"},
+            "simplify_layer_selection": {"value": False, "vtype": bool, "label": "Simplify selection from layer",
+                                         "tooltip": "Simplify geometries of selection created from a layer with "
+                                                    "tolerance of half of the raster pixel size"},
+            "tile_size": {"value": 1024, "vtype": int, "label": "Processing tile size (cells)", "max": 100000,
+                          "tooltip": "Selections are read, modified and written in tiles of this size. "
+                                     "Use 0 to process whole selection block at once."},
         }
         self.settings = dict()
         s = QSettings()
@@ -143,20 +218,27 @@ class Serval(object):
 
     def edit_settings(self):
         """Open dialog with plugin settings."""
+        dlg = SettingsDialog(self.default_settings, self.settings, self.iface.mainWindow())
+        if not dlg.exec_():
+            return
         s = QSettings()
         s.beginGroup("serval")
-        k = "undo_steps"
-        cur_val = self.settings[k]
-        val_type = self.default_settings[k]["vtype"]
-        cur_steps = s.value(k, cur_val, val_type)
-
-        label = 'Nr of Undo/Redo steps:'
-        steps, ok = QInputDialog.getInt(None, "Serval Settings", label, cur_steps)
-        if not ok:
-            return
-        if steps >= 0:
-            s.setValue("undo_steps", steps)
+        for k, v in dlg.get_values().items():
+            s.setValue(k, v)
         self.load_settings()
+        if self.handler is not None:
+            self.handler.tile_size = self.settings["tile_size"]
+            if self.settings["edit_session"]:
+                self.handler.start_session()
+            else:
+                self.end_edit_session()
+        self.set_autosave_timer()
+        self.index_cache.max_bytes = self.settings["index_memory"] * 1024 ** 2
+        self.index_cache.evict()
+        self.mesh_cache.max_bytes = self.settings["index_memory"] * 1024 ** 2
+        self.mesh_cache.evict()
+        self.feature_cache.max_bytes = self.settings["features_memory"] * 1024 ** 2
+        self.feature_cache.evict()
         self.uc.show_info("Some new settings may require QGIS restart.")
 
     def initGui(self):
@@ -209,6 +291,32 @@ class Serval(object):
             checkable=True, )
         self.map_tool_btn[self.draw_tool] = self.draw_btn
 
+        self.brush_btn = self.add_action(
+            'brush.svg',
+            text="Paint Value(s) With Brush",
+            callback=self.activate_brush,
+            add_to_toolbar=self.toolbar,
+            checkable=True, )
+        self.map_tool_btn[self.brush_tool] = self.brush_btn
+
+        self.brush_radius_sbox = QgsDoubleSpinBox()
+        self.brush_radius_sbox.setMinimumSize(QSize(50, 24))
+        self.brush_radius_sbox.setMaximumSize(QSize(50, 24))
+        self.brush_radius_sbox.setMinimum(0)
+        self.brush_radius_sbox.setMaximum(1000000)
+        self.brush_radius_sbox.setValue(3)
+        self.brush_radius_sbox.setShowClearButton(False)
+        self.brush_radius_sbox.setToolTip("Brush Radius")
+        self.brush_radius_sbox.valueChanged.connect(self.update_brush_tool)
+
+        self.brush_unit_cbo = QComboBox()
+        for u in ("pixels", "map units", ):
+            self.brush_unit_cbo.addItem(u)
+        self.brush_unit_cbo.setToolTip("Brush Radius Unit")
+        self.toolbar.addWidget(self.brush_radius_sbox)
+        self.toolbar.addWidget(self.brush_unit_cbo)
+        self.brush_unit_cbo.currentIndexChanged.connect(self.update_brush_tool)
+
         self.apply_spin_box_values_btn = self.add_action(
             'apply_const_value.svg',
             text="Apply Value(s) to Selection",
@@ -230,7 +338,7 @@ class Serval(object):
 
         self.low_pass_filter_btn = self.add_action(
             'apply_low_pass_filter.svg',
-            text="Apply Low-Pass 3x3 Filter To Selection",
+            text="Apply Low-Pass Filter To Selection",
             callback=self.apply_low_pass_filter,
             add_to_toolbar=self.toolbar,
             checkable=False, )
@@ -247,6 +355,12 @@ class Serval(object):
             callback=self.redo,
             add_to_toolbar=self.toolbar, )
 
+        self.commit_btn = self.add_action(
+            'commit_edits.svg',
+            text="Commit Buffered Edits",
+            callback=self.commit_edits,
+            add_to_toolbar=self.toolbar, )
+
         self.set_nodata_btn = self.add_action(
             'set_nodata.svg',
             text="Edit Raster NoData Values",
@@ -362,7 +476,29 @@ class Serval(object):
         return action
 
     def unload(self):
+        self.stroke_timer.stop()
+        self.autosave_timer.stop()
+        self.stroke_change = None
+        # drop queued edit tasks and wait for the running one, so that handlers of the tasks can be closed
+        tasks, self.edit_tasks = self.edit_tasks, []
+        handlers = []
+        for task in tasks:
+            if task.handler is not self.handler and all(task.handler is not handler for handler in handlers):
+                handlers.append(task.handler)
+        if tasks and not tasks[0].waitForFinished():
+            self.uc.bar_warn("Raster edit is still running - its raster can't be closed.")
+            handlers = [handler for handler in handlers if handler is not tasks[0].handler]
+            if tasks[0].handler is self.handler:
+                self.handler = None
+        for handler in handlers:
+            self.close_raster_handler(handler)
+        self.close_handler()
+        self.retry_closing_handlers()
         self.changes = None
+        self.index_cache.clear()
+        self.feature_cache.clear()
+        self.mesh_cache.clear()
+        self.selection_cache.clear()
         if self.selection_tool:
             self.selection_tool.reset()
         if self.spin_boxes is not None:
@@ -402,6 +538,7 @@ class Serval(object):
     def uncheck_all_btns(self):
         self.probe_btn.setChecked(False)
         self.draw_btn.setChecked(False)
+        self.brush_btn.setChecked(False)
         self.gom_btn.setChecked(False)
         self.line_select_btn.setChecked(False)
         self.polygon_select_btn.setChecked(False)
@@ -421,14 +558,17 @@ class Serval(object):
         self.canvas.setMapTool(self.probe_tool)
 
     def define_expression(self):
+        if self.raster_busy():
+            return
         if not self.selection_tool.selected_geometries:
             self.uc.bar_warn("No selection for raster layer. Select some cells and retry...")
             return
-        self.handler.select(self.selection_tool.selected_geometries, all_touched_cells=self.all_touched)
-        self.handler.create_cell_pts_layer()
-        if self.handler.cell_pts_layer.featureCount() == 0:
+        self.sync_selection()
+        if self.handler.selection is None:
             self.uc.bar_warn("No selection for raster layer. Select some cells and retry...")
             return
+        # the layer is used only for the expression preview in the builder, so a few cells are enough
+        self.handler.create_cell_pts_layer(max_cells=self.EXP_PREVIEW_CELLS)
         self.exp_dlg = QgsExpressionBuilderDialog(self.handler.cell_pts_layer)
         self.exp_builder = self.exp_dlg.expressionBuilder()
         self.exp_dlg.accepted.connect(self.apply_exp_value)
@@ -437,18 +577,57 @@ class Serval(object):
     def apply_exp_value(self):
         if not self.exp_dlg.expressionText() or not self.exp_builder.isExpressionValid():
             return
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        exp = self.exp_dlg.expressionText()
-        idx = self.handler.cell_pts_layer.addExpressionField(exp, QgsField('exp_val', QVariant.Double))
-        self.handler.exp_field_idx = idx
-        self.handler.write_block()
-        QApplication.restoreOverrideCursor()
-        self.raster.triggerRepaint()
+        exp_text = self.exp_dlg.expressionText()
+        threads = self.settings["exp_threads"]
+        # the expression is evaluated in background threads, but layers snapshots must be created and layers signals
+        # connected to the caches in the main thread
+        self.watch_exp_layers(exp_text)
+        snapshots = [self.layer_snapshots(exp_text) for _ in range(threads)]
+
+        def init_worker():
+            self.thread_data.snapshots = snapshots.pop()
+
+        evaluator = CellExpressionEvaluator(exp_text, self.project, bulk_functions=self.bulk_exp_functions())
+        self.run_edit_task("Applying expression values", evaluator=evaluator, threads=threads, init_worker=init_worker)
+
+    def sync_selection(self):
+        """Select cells of all the selecting geometries, unless the handler selection mask is up to date."""
+        if self.selection_synced:
+            return
+        geometries = self.selection_tool.selected_geometries
+        if geometries:
+            self.handler.select(geometries, all_touched_cells=self.all_touched)
+        else:
+            self.handler.clear_selection(self.all_touched)
+        self.selection_synced = True
+
+    def update_raster_selection(self, mode, geometries):
+        """
+        Update the handler selection mask incrementally with geometries added to, or removed from, the selection.
+        The mask is not changed while edit tasks use it - a complete selection will be done for the next edit then.
+        """
+        self.selection_cache.clear()
+        if self.handler is None or self.edit_tasks or not self.selection_synced:
+            self.selection_synced = False
+            return
+        if mode == RasterCellSelectionMapTool.NEW_SELECTION:
+            self.handler.clear_selection(self.all_touched)
+            synced = self.handler.add_to_selection(geometries)
+        elif mode == RasterCellSelectionMapTool.ADD_TO_SELECTION:
+            synced = self.handler.add_to_selection(geometries)
+        else:
+            synced = self.handler.remove_from_selection(geometries, self.selection_tool.selected_geometries)
+        self.selection_synced = synced
 
     def activate_drawing(self):
         self.mode = 'draw'
         self.canvas.setMapTool(self.draw_tool)
 
+    def activate_brush(self):
+        self.mode = 'draw'
+        self.update_brush_tool()
+        self.canvas.setMapTool(self.brush_tool)
+
     def get_cur_line_width(self):
         width_coef = {
             "map units": 1.,
@@ -482,29 +661,149 @@ class Serval(object):
         else:
             pass
 
+    def run_edit_task(self, description, **kwargs):
+        """
+        Run edit of currently selected cells as a background task, kwargs are passed to RasterEditTask.
+        If an edit task is running already, the new one is queued and started when the previous ones are finished.
+        """
+        if self.selection_synced:
+            # the selection mask is up to date (or will be, when queued tasks are finished) - no selection needed
+            if self.handler.selection is None and not self.edit_tasks:
+                self.uc.bar_warn("Select some raster cells!")
+                return
+            geometries = None
+        else:
+            geometries = self.handler.transform_geometries(self.selection_tool.selected_geometries or [])
+            if not geometries:
+                if geometries is not None:
+                    self.uc.bar_warn("Select some raster cells!")
+                return
+            self.selection_synced = True
+        task = RasterEditTask(f"Serval: {description}", self.handler, geometries, self.all_touched,
+                              self.edit_task_finished, **kwargs)
+        self.edit_tasks.append(task)
+        if len(self.edit_tasks) == 1:
+            QgsApplication.taskManager().addTask(task)
+        else:
+            self.uc.bar_info("Raster is busy - the edit will start when previous edits are finished.", dur=3)
+
+    def edit_task_finished(self, task, result):
+        """Store the change of finished edit task and start the next queued task, if any."""
+        if task not in self.edit_tasks:
+            # the plugin was unloaded meanwhile, the task handler is closed already
+            return
+        self.edit_tasks.remove(task)
+        if task.handler is not self.handler and not any(t.handler is task.handler for t in self.edit_tasks):
+            # the raster is not active anymore, commit edits buffered during the task and close the handler
+            self.close_raster_handler(task.handler)
+        if result:
+            self.add_to_undo(task.change, layer_id=task.layer_id)
+        elif task.error:
+            self.uc.bar_warn(f"Raster edit failed: {task.error}")
+        elif task.isCanceled():
+            self.uc.bar_info("Raster edit canceled.", dur=3)
+        task.handler.refresh_layer()
+        if self.edit_tasks:
+            QgsApplication.taskManager().addTask(self.edit_tasks[0])
+
+    def raster_busy(self):
+        """Check if there are edit tasks running or queued and warn the user."""
+        if self.edit_tasks:
+            self.uc.bar_warn("Raster is busy - wait for the edits to finish.", dur=3)
+            return True
+        return False
+
     def apply_values(self, new_values):
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.handler.select(self.selection_tool.selected_geometries, all_touched_cells=self.all_touched)
-        self.handler.write_block(new_values)
-        QApplication.restoreOverrideCursor()
-        self.raster.triggerRepaint()
+        self.run_edit_task("Applying values", const_values=new_values)
 
-    def apply_values_single_cell(self, new_vals):
-        """Create single cell selection and apply the new values."""
-        cp = self.last_point
-        if self.logger:
-            self.logger.debug(f"Changing single cell for pt {cp}")
-        col, row = self.handler.point_to_index([cp.x(), cp.y()])
-        px, py = self.handler.index_to_point(row, col, upper_left=False)
-        d = 0.001
-        bbox = QgsRectangle(px - d, py - d, px + d, py + d)
+    def start_stroke(self):
+        """Start drawing a stroke - all cells drawn until the mouse button is released make a single undo step."""
+        self.stroke_change = None
+        self.stroke_cell = None
+        self.stroke_cells = []
+        if self.raster is None:
+            self.uc.bar_warn("Choose a raster to work with...", dur=3)
+            return
+        if self.raster_busy():
+            return
+        self.stroke_values = self.spin_boxes.get_values()
         if self.logger:
-            self.logger.debug(f"Changing single cell in {bbox}")
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.handler.select([QgsGeometry.fromRect(bbox)], all_touched_cells=False, transform=False)
-        self.handler.write_block(new_vals)
-        QApplication.restoreOverrideCursor()
-        self.raster.triggerRepaint()
+            self.logger.debug(f"Drawing const value {self.stroke_values}")
+        self.stroke_brush = self.get_brush_rows() if self.canvas.mapTool() is self.brush_tool else None
+        self.stroke_change = RasterChange(self.handler.active_bands)
+        self.handler.start_stroke()
+
+    def draw_segment(self, start, end):
+        """
+        Add cells on the stroke segment between the points in map canvas CRS to the stroke. The cells are written
+        when the stroke frame timer fires, so that pointer moves within a frame are coalesced into a single write.
+        """
+        if self.stroke_change is None:
+            return
+        start, end = self.to_raster_crs(start), self.to_raster_crs(end)
+        if start is None or end is None:
+            self.stroke_change = None
+            return
+        row_0, col_0 = self.handler.point_to_cell(start.x(), start.y())
+        row_1, col_1 = self.handler.point_to_cell(end.x(), end.y())
+        if (row_0, col_0) == (row_1, col_1) == self.stroke_cell:
+            return
+        self.stroke_cell = (row_1, col_1)
+        self.stroke_cells.append(line_cells(row_0, col_0, row_1, col_1))
+        if not self.stroke_timer.isActive():
+            self.stroke_timer.start()
+
+    def write_stroke_cells(self):
+        """Write the stroke cells collected since the last frame and repaint the raster."""
+        if self.stroke_change is None or not self.stroke_cells:
+            return
+        rows = numpy.concatenate([cells[0] for cells in self.stroke_cells])
+        cols = numpy.concatenate([cells[1] for cells in self.stroke_cells])
+        self.stroke_cells = []
+        if self.stroke_brush is None:
+            self.handler.write_cells(rows, cols, self.stroke_values, change=self.stroke_change)
+        else:
+            selection = CellSelection.from_stroke(rows, cols, self.stroke_brush,
+                                                  self.handler.raster_rows, self.handler.raster_cols)
+            for runs in selection.chunks() if selection is not None else []:
+                self.handler.write_cells(*selection.indices(runs), self.stroke_values, change=self.stroke_change)
+                if self.handler.error:
+                    break
+        if self.handler.error:
+            self.uc.show_warn(self.handler.error)
+            self.stroke_change = None
+            return
+        self.refresh_raster()
+
+    def finish_stroke(self):
+        """Finish the stroke - add its cells to undo stack as a single change."""
+        self.stroke_timer.stop()
+        self.write_stroke_cells()
+        if self.handler is not None:
+            self.handler.finish_stroke()
+        change = self.stroke_change
+        self.stroke_change = None
+        if change is not None and change.tiles:
+            self.add_to_undo(change)
+
+    def get_brush_rows(self):
+        """Return rows of the brush of current radius, see utils.brush_rows."""
+        radius = self.brush_radius_sbox.value()
+        if self.brush_unit_cbo.currentText() == "map units":
+            return brush_rows(radius / self.raster.rasterUnitsPerPixelY(),
+                              radius / self.raster.rasterUnitsPerPixelX())
+        return brush_rows(radius, radius)
+
+    def update_brush_tool(self):
+        """Set brush tool outline radius in map units."""
+        radius = self.brush_radius_sbox.value()
+        if self.raster is not None and self.brush_unit_cbo.currentText() == "pixels":
+            radius *= self.raster.rasterUnitsPerPixelX()
+        self.brush_tool.set_radius(radius)
+
+    def refresh_raster(self):
+        if self.handler is not None:
+            self.handler.refresh_layer()
 
     def apply_spin_box_values(self):
         if not self.selection_tool.selected_geometries:
@@ -517,11 +816,13 @@ class Serval(object):
         self.apply_values(self.handler.nodata_values)
 
     def apply_low_pass_filter(self):
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.handler.select(self.selection_tool.selected_geometries, all_touched_cells=self.all_touched)
-        self.handler.write_block(low_pass_filter=True)
-        QApplication.restoreOverrideCursor()
-        self.raster.triggerRepaint()
+        try:
+            raster_filter = RasterFilter(self.settings["filter_kernel"], self.settings["filter_size"],
+                                         self.settings["filter_weights"])
+        except ValueError as err:
+            self.uc.bar_warn(f"Check the filter settings: {err}")
+            return
+        self.run_edit_task("Applying low-pass filter", raster_filter=raster_filter)
 
     def clear_selection(self):
         if self.selection_tool:
@@ -536,7 +837,7 @@ class Serval(object):
         cur_layer = dlg.cbo.currentLayer()
         if not cur_layer.type() == QgsMapLayerType.VectorLayer:
             return
-        self.selection_tool.selection_from_layer(cur_layer)
+        self.selection_tool.selection_from_layer(cur_layer, simplify=self.settings["simplify_layer_selection"])
 
     def selection_to_layer(self):
         """Create a memory layer from current selection"""
@@ -561,11 +862,15 @@ class Serval(object):
         """Toggle selection mode."""
         # button is toggled automatically when clicked, just update the attribute
         self.all_touched = self.toggle_all_touched_btn.isChecked()
+        self.selection_synced = False
 
     def point_clicked(self, point=None, button=None):
         if self.raster is None:
             self.uc.bar_warn("Choose a raster to work with...", dur=3)
             return
+        if self.raster_busy():
+            # edit tasks switch the raster data provider to editing mode and write blocks - don't read it meanwhile
+            return
 
         if self.logger:
             self.logger.debug(f"Clicked point in canvas CRS: {point if point else self.last_point}")
@@ -573,25 +878,14 @@ class Serval(object):
         if point is None:
             ptxy_in_src_crs = self.last_point
         else:
-            if self.crs_transform:
-                if self.logger:
-                    self.logger.debug(f"Transforming clicked point {point}")
-                try:
-                    ptxy_in_src_crs = self.crs_transform.transform(point)
-                except QgsCsException as err:
-                    self.uc.show_warn(
-                        "Point coordinates transformation failed! Check the raster projection:\n\n{}".format(repr(err)))
-                    return
-            else:
-                ptxy_in_src_crs = QgsPointXY(point.x(), point.y())
+            ptxy_in_src_crs = self.to_raster_crs(point)
+            if ptxy_in_src_crs is None:
+                return
 
         if self.logger:
             self.logger.debug(f"Clicked point in raster CRS: {ptxy_in_src_crs}")
         self.last_point = ptxy_in_src_crs
 
-        ident_vals = self.handler.provider.identify(ptxy_in_src_crs, QgsRaster.IdentifyFormatValue).results()
-        cur_vals = list(ident_vals.values())
-
         # check if the point is within active raster extent
         if not self.rbounds[0] <= ptxy_in_src_crs.x() <= self.rbounds[2]:
             self.uc.bar_info("Out of x bounds", dur=3)
@@ -600,17 +894,25 @@ class Serval(object):
             self.uc.bar_info("Out of y bounds", dur=3)
             return
 
-        if self.mode == 'draw':
-            new_vals = self.spin_boxes.get_values()
-            if self.logger:
-                self.logger.debug(f"Applying const value {new_vals}")
-            self.apply_values_single_cell(new_vals)
-        else:
-            self.spin_boxes.set_values(cur_vals)
-            if 2 < self.handler.bands_nr < 5:
-                self.color_picker_connection(connect=False)
-                self.color_btn.setColor(QColor(*self.spin_boxes.get_values()[:4]))
-                self.color_picker_connection(connect=True)
+        cur_vals = self.handler.point_values(ptxy_in_src_crs)
+        self.spin_boxes.set_values(cur_vals)
+        if 2 < self.handler.bands_nr < 5:
+            self.color_picker_connection(connect=False)
+            self.color_btn.setColor(QColor(*self.spin_boxes.get_values()[:4]))
+            self.color_picker_connection(connect=True)
+
+    def to_raster_crs(self, point):
+        """Return the map canvas point transformed to raster CRS, or None if the transformation fails."""
+        if not self.crs_transform:
+            return QgsPointXY(point.x(), point.y())
+        if self.logger:
+            self.logger.debug(f"Transforming point {point}")
+        try:
+            return self.crs_transform.transform(point)
+        except QgsCsException as err:
+            self.uc.show_warn(
+                "Point coordinates transformation failed! Check the raster projection:\n\n{}".format(repr(err)))
+            return None
 
     def set_values_from_picker(self, c):
         """Set bands spinboxes values after color change in the color picker"""
@@ -666,7 +968,8 @@ class Serval(object):
         self.raster.triggerRepaint()
         
     def check_undo_redo_btns(self):
-        """Enable/Disable undo and redo buttons based on availability of undo/redo for current raster."""
+        """Enable/Disable undo, redo and commit buttons based on availability of undo/redo for current raster."""
+        self.commit_btn.setEnabled(self.raster is not None and self.handler.has_uncommitted_edits())
         self.undo_btn.setDisabled(True)
         self.redo_btn.setDisabled(True)
         if self.raster is None or self.raster.id() not in self.changes:
@@ -679,7 +982,8 @@ class Serval(object):
 
     def enable_toolbar_actions(self, enable=True):
         """Enable / disable all toolbar actions but Help (for vectors and unsupported rasters)"""
-        for widget in self.actions + [self.width_unit_cbo, self.line_width_sbox]:
+        for widget in self.actions + [self.width_unit_cbo, self.line_width_sbox, self.brush_radius_sbox,
+                                      self.brush_unit_cbo]:
             widget.setEnabled(enable)
             if widget in self.actions_always_on:
                 widget.setEnabled(True)
@@ -730,10 +1034,27 @@ class Serval(object):
             self.raster = layer
             self.crs_transform = None if self.project.crs() == self.raster.crs() else \
                 QgsCoordinateTransform(self.project.crs(), self.raster.crs(), self.project)
-            self.handler = RasterHandler(self.raster, self.uc, self.debug)
+            self.close_handler()
+            self.selection_synced = False
+            self.selection_cache.clear()
+            unclosed = [handler for handler in self.unclosed_handlers if handler.layer is self.raster]
+            if unclosed:
+                # the raster has edits, which failed to be committed - keep working with them
+                self.handler = unclosed[0]
+                self.unclosed_handlers.remove(self.handler)
+                self.handler.raster_changed.disconnect(self.add_to_undo)
+            else:
+                self.handler = RasterHandler(self.raster, self.uc, self.debug, tile_size=self.settings["tile_size"],
+                                             use_gdal=self.settings["gdal_backend"],
+                                             selection_cache=self.selection_cache)
+            if self.settings["edit_session"]:
+                self.handler.start_session()
+            self.handler.clear_selection(self.all_touched)
+            self.selection_synced = not self.selection_tool.selected_geometries
             supported, unsupported_type = self.handler.write_supported()
             if supported:
                 self.enable_toolbar_actions()
+                self.update_brush_tool()
                 self.set_bands_cbo()
                 self.spin_boxes.create_spinboxes(self.handler.active_bands,
                                                  self.handler.data_types, self.handler.nodata_values)
@@ -744,7 +1065,7 @@ class Serval(object):
                 self.rbounds = self.raster.extent().toRectF().getCoords()
                 self.handler.raster_changed.connect(self.add_to_undo)
                 if self.raster.id() not in self.changes:
-                    self.changes[self.raster.id()] = RasterChanges(nr_to_keep=self.settings["undo_steps"])
+                    self.changes[self.raster.id()] = self.create_raster_changes()
             else:
                 msg = f"The raster has unsupported src_data type: {unsupported_type}"
                 msg += "\nServal can't work with it, sorry..."
@@ -759,9 +1080,30 @@ class Serval(object):
 
         self.check_undo_redo_btns()
 
-    def add_to_undo(self, change):
-        """Add the old and new blocks to undo stack."""
-        self.changes[self.raster.id()].add_change(change)
+    def create_raster_changes(self):
+        """Create changes manager for current raster, using undo journal file if it is enabled in settings."""
+        if not self.settings["undo_journal"]:
+            return RasterChanges(
+                nr_to_keep=self.settings["undo_steps"], max_bytes=self.settings["undo_memory"] * 1024 ** 2)
+        raster_path = os.path.abspath(self.raster.dataProvider().dataSourceUri())
+        journal_dir = self.settings["journal_dir"] or os.path.join(QgsApplication.qgisSettingsDirPath(), "serval")
+        os.makedirs(journal_dir, exist_ok=True)
+        journal_name = hashlib.sha1(raster_path.encode()).hexdigest() + ".journal"
+        raster_meta = {
+            "raster": raster_path,
+            "width": self.handler.raster_cols,
+            "height": self.handler.raster_rows,
+            "data_types": self.handler.data_types,
+        }
+        journal = ChangeJournal(os.path.join(journal_dir, journal_name), raster_meta)
+        changes = RasterChanges(nr_to_keep=self.settings["journal_steps"], journal=journal)
+        if changes.nr_undos() or changes.nr_redos():
+            self.uc.bar_info(f"Undo history restored from journal: {changes.nr_undos()} undo steps", dur=3)
+        return changes
+
+    def add_to_undo(self, change, layer_id=None):
+        """Add the change to undo stack of the layer (current raster by default)."""
+        self.changes[layer_id if layer_id else self.raster.id()].add_change(change)
         self.check_undo_redo_btns()
         if self.logger:
             self.logger.debug(self.get_undo_redo_values())
@@ -771,18 +1113,87 @@ class Serval(object):
         return f"nr undos: {changes.nr_undos()}, redos: {changes.nr_redos()}"
 
     def undo(self):
+        if self.raster_busy():
+            return
         undo_data = self.changes[self.raster.id()].undo()
         self.handler.write_block_undo(undo_data)
-        self.raster.triggerRepaint()
+        self.handler.refresh_layer()
         self.check_undo_redo_btns()
 
     def redo(self):
+        if self.raster_busy():
+            return
         redo_data = self.changes[self.raster.id()].redo()
         self.handler.write_block_undo(redo_data)
-        self.raster.triggerRepaint()
+        self.handler.refresh_layer()
         self.check_undo_redo_btns()
 
+    def set_autosave_timer(self):
+        """Start or stop buffered edits autosave timer according to the settings."""
+        if self.settings["edit_session"] and self.settings["autosave_interval"] > 0:
+            self.autosave_timer.start(self.settings["autosave_interval"] * 1000)
+        else:
+            self.autosave_timer.stop()
+
+    def commit_edits(self):
+        """Write edits buffered in memory to the raster."""
+        if self.handler is None or self.raster_busy():
+            return
+        self.retry_closing_handlers()
+        if self.handler.commit_session():
+            self.handler.refresh_layer()
+            self.uc.bar_info("Buffered edits committed.", dur=2)
+        elif self.handler.error:
+            self.uc.bar_warn(f"Committing edits failed: {self.handler.error}")
+        self.check_undo_redo_btns()
+
+    def autosave_edits(self):
+        """Commit buffered edits, unless there are edit tasks running."""
+        if self.handler is None or self.edit_tasks:
+            return
+        self.retry_closing_handlers()
+        if self.handler.commit_session():
+            self.handler.refresh_layer()
+            self.check_undo_redo_btns()
+
+    def end_edit_session(self):
+        """Commit edits buffered for current handler and stop buffering, e.g. before another raster gets active."""
+        if self.handler is not None and not any(task.handler is self.handler for task in self.edit_tasks):
+            if not self.handler.end_session():
+                self.uc.bar_warn(f"Committing buffered edits failed: {self.handler.error} - the edit session goes on "
+                                 f"and the edits are kept in memory.")
+
+    def close_handler(self):
+        """
+        Close current handler, committing its buffered edits and releasing the GDAL backend, before it is replaced.
+        Handlers used by edit tasks are closed when the tasks are finished.
+        """
+        if self.handler is not None and not any(task.handler is self.handler for task in self.edit_tasks):
+            self.close_raster_handler(self.handler)
+
+    def close_raster_handler(self, handler):
+        """
+        Close the handler. If committing its buffered edits fails, the edits are kept in memory and the handler is
+        kept for closing it again later.
+        """
+        if handler.close():
+            if handler in self.unclosed_handlers:
+                self.unclosed_handlers.remove(handler)
+            return True
+        if handler not in self.unclosed_handlers:
+            self.unclosed_handlers.append(handler)
+        self.uc.bar_warn(f"Committing buffered edits failed: {handler.error} - the edits are kept in memory, "
+                         f"committing will be repeated with next commit.")
+        return False
+
+    def retry_closing_handlers(self):
+        """Try to commit buffered edits of inactive rasters, which failed before, and close their handlers."""
+        for handler in list(self.unclosed_handlers):
+            if handler is not self.handler and not any(task.handler is handler for task in self.edit_tasks):
+                self.close_raster_handler(handler)
+
     def reset_raster(self):
+        self.close_handler()
         self.raster = None
         self.color_btn.setDisabled(True)
 
@@ -796,30 +1207,57 @@ class Serval(object):
     def show_website():
         QDesktopServices.openUrl(QUrl("https://github.com/lutraconsulting/serval/blob/master/Serval/docs/user_manual.md"))
 
-    def recreate_spatial_index(self, layer):
-        """Check if spatial index exists for the layer and if it is relatively old and eventually recreate it."""
-        ctime = self.spatial_index_time[layer.id()] if layer.id() in self.spatial_index_time else None
-        if ctime is None or datetime.now() - ctime > timedelta(seconds=30):
-            self.spatial_index = QgsSpatialIndex(layer.getFeatures(), None, QgsSpatialIndex.FlagStoreFeatureGeometries)
-            self.spatial_index_time[layer.id()] = datetime.now()
+    def get_spatial_index(self, layer):
+        """Return cached spatial index of the layer, building it from the layer (snapshot) features if needed."""
+        return self.index_cache.get_index(layer, self.feature_source(layer))
 
-    def get_nearest_feature(self, pt_feat, vlayer_id):
-        """Given the point feature, return nearest feature from vlayer."""
-        vlayer = self.project.mapLayer(vlayer_id)
-        self.recreate_spatial_index(vlayer)
+    def watch_exp_layers(self, exp_text):
+        """Connect change signals of layers used in the expression to the caches, before a task evaluates it."""
+        for layer_id, layer in self.project.mapLayers().items():
+            if layer_id not in exp_text:
+                continue
+            if layer.type() == QgsMapLayerType.VectorLayer:
+                self.index_cache.watch_layer(layer)
+                self.feature_cache.watch_layer(layer)
+            elif layer.type() == QgsMapLayerType.MeshLayer:
+                self.mesh_cache.watch_layer(layer)
+
+    def layer_snapshots(self, exp_text):
+        """Return feature sources (snapshots) of vector layers used in the expression, for use in a worker thread."""
+        snapshots = dict()
+        for layer_id, layer in self.project.mapLayers().items():
+            if layer_id in exp_text and layer.type() == QgsMapLayerType.VectorLayer:
+                snapshots[layer_id] = QgsVectorLayerFeatureSource(layer)
+        return snapshots
+
+    def feature_source(self, layer):
+        """Return the layer snapshot if the current thread is an expression worker with snapshots, or the layer."""
+        snapshots = getattr(self.thread_data, "snapshots", None)
+        if snapshots and layer.id() in snapshots:
+            return snapshots[layer.id()]
+        return layer
+
+    def get_cached_features(self, vlayer, attr_names, with_geometry=True):
+        """Return cached geometries and attr_names values of vlayer features, read from the layer (snapshot)."""
+        return self.feature_cache.get_features(vlayer, attr_names, with_geometry, self.feature_source(vlayer))
+
+    def get_nearest_fid(self, pt_feat, vlayer):
+        """Given the point feature, return id of the nearest feature from vlayer."""
+        spatial_index = self.get_spatial_index(vlayer)
         ptxy = pt_feat.geometry().asPoint()
-        near_fid = self.spatial_index.nearestNeighbor(ptxy)[0]
-        return vlayer.getFeature(near_fid)
+        return spatial_index.nearestNeighbor(ptxy)[0]
 
     def nearest_feature_attr_value(self, pt_feat, vlayer_id, attr_name):
         """Find nearest feature to pt_feat and return its attr_name attribute value."""
-        near_feat = self.get_nearest_feature(pt_feat, vlayer_id)
-        return near_feat[attr_name]
+        vlayer = self.project.mapLayer(vlayer_id)
+        near_fid = self.get_nearest_fid(pt_feat, vlayer)
+        return self.get_cached_features(vlayer, [attr_name], with_geometry=False).attributes[attr_name][near_fid]
 
     def nearest_pt_on_line_interpolate_z(self, pt_feat, vlayer_id):
         """Find nearest line feature to pt_feat and interpolate z value from vertices."""
-        near_feat = self.get_nearest_feature(pt_feat, vlayer_id)
-        near_geom = near_feat.geometry()
+        vlayer = self.project.mapLayer(vlayer_id)
+        near_fid = self.get_nearest_fid(pt_feat, vlayer)
+        near_geom = self.get_cached_features(vlayer, []).geometries[near_fid]
         closest_pt_dist = near_geom.lineLocatePoint(pt_feat.geometry())
         closest_pt = near_geom.interpolate(closest_pt_dist)
         return closest_pt.get().z()
@@ -830,24 +1268,30 @@ class Serval(object):
         value of their attr_name attribute.
         """
         vlayer = self.project.mapLayer(vlayer_id)
-        self.recreate_spatial_index(vlayer)
+        spatial_index = self.get_spatial_index(vlayer)
         ptxy = pt_feat.geometry().asPoint()
-        pt_x, pt_y = ptxy.x(), ptxy.y()
-        dxy = 0.001
+        cell = self.cell_rectangle(ptxy.x(), ptxy.y(), only_center)
+        features = self.get_cached_features(vlayer, [attr_name])
+        return self.features_attr_average(features, spatial_index.intersects(cell), cell, attr_name)
+
+    def cell_rectangle(self, pt_x, pt_y, only_center):
+        """Return rectangle of raster cell with center at pt_x, pt_y, or a tiny rectangle at the center only."""
+        if only_center:
+            dxy = 0.001
+            return QgsRectangle(pt_x, pt_y, pt_x + dxy, pt_y + dxy)
         half_pix_x = self.handler.pixel_size_x / 2.
         half_pix_y = self.handler.pixel_size_y / 2.
-        if only_center:
-            cell = QgsRectangle(pt_x, pt_y, pt_x + dxy, pt_y + dxy)
-        else:
-            cell = QgsRectangle(pt_x - half_pix_x, pt_y - half_pix_y,
-                                pt_x + half_pix_x, pt_y + half_pix_y)
-        inter_fids = self.spatial_index.intersects(cell)
+        return QgsRectangle(pt_x - half_pix_x, pt_y - half_pix_y, pt_x + half_pix_x, pt_y + half_pix_y)
+
+    @staticmethod
+    def features_attr_average(features, fids, cell, attr_name):
+        """Return average of numeric attr_name values of cached features of fids intersecting the cell, or None."""
+        cell_geom = QgsGeometry.fromRect(cell)
         values = []
-        for fid in inter_fids:
-            feat = vlayer.getFeature(fid)
-            if not feat.geometry().intersects(cell):
+        for fid in fids:
+            if features.geometries[fid].isNull() or not features.engine(fid).intersects(cell_geom.constGet()):
                 continue
-            val = feat[attr_name]
+            val = features.attributes[attr_name][fid]
             if not is_number(val):
                 continue
             values.append(val)
@@ -859,15 +1303,78 @@ class Serval(object):
         """Interpolate from mesh."""
         mesh_layer = self.project.mapLayer(mesh_layer_id)
         ptxy = pt_feat.geometry().asPoint()
-        dataset_val = mesh_layer.datasetValue(QgsMeshDatasetIndex(group, dataset), ptxy)
+        # mesh layer and raster provider are not thread-safe
+        with self.exp_lock:
+            dataset_val = mesh_layer.datasetValue(QgsMeshDatasetIndex(group, dataset), ptxy)
         val = dataset_val.scalar()
         if math.isnan(val):
             return val
         if above_existing:
-            ident_vals = self.handler.provider.identify(ptxy, QgsRaster.IdentifyFormatValue).results()
-            org_val = list(ident_vals.values())[0]
-            if org_val == self.handler.nodata_values[0]:
+            with self.exp_lock:
+                org_val = self.handler.point_values(ptxy, bands=[1])[0]
+            if org_val is None:
                 return val
             return max(org_val, val)
         else:
             return val
+
+    def bulk_exp_functions(self):
+        """Return dict of bulk versions of Serval expression functions, evaluating all cells at once."""
+        return {
+            "nearest_feature_attr_value": self.nearest_feature_attr_values,
+            "nearest_pt_on_line_interpolate_z": self.nearest_pt_on_line_interpolate_z_values,
+            "intersecting_features_attr_average": self.intersecting_features_attr_averages,
+            "interpolate_from_mesh": self.interpolate_from_mesh_values,
+        }
+
+    def nearest_fids(self, vlayer, xs, ys):
+        """Return list of ids of vlayer features nearest to the points."""
+        spatial_index = self.get_spatial_index(vlayer)
+        return [spatial_index.nearestNeighbor(QgsPointXY(x, y))[0] for x, y in zip(xs.tolist(), ys.tolist())]
+
+    def nearest_feature_attr_values(self, rows, cols, xs, ys, vlayer_id, attr_name):
+        """Bulk version of nearest_feature_attr_value for cells centers xs, ys."""
+        vlayer = self.project.mapLayer(vlayer_id)
+        fids = self.nearest_fids(vlayer, xs, ys)
+        attr_values = self.get_cached_features(vlayer, [attr_name], with_geometry=False).attributes[attr_name]
+        return [attr_values[fid] for fid in fids]
+
+    def nearest_pt_on_line_interpolate_z_values(self, rows, cols, xs, ys, vlayer_id):
+        """Bulk version of nearest_pt_on_line_interpolate_z for cells centers xs, ys."""
+        vlayer = self.project.mapLayer(vlayer_id)
+        fids = self.nearest_fids(vlayer, xs, ys)
+        geometries = self.get_cached_features(vlayer, []).geometries
+        values = []
+        for fid, x, y in zip(fids, xs.tolist(), ys.tolist()):
+            near_geom = geometries[fid]
+            closest_pt_dist = near_geom.lineLocatePoint(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+            values.append(near_geom.interpolate(closest_pt_dist).get().z())
+        return values
+
+    def intersecting_features_attr_averages(self, rows, cols, xs, ys, vlayer_id, attr_name, only_center):
+        """Bulk version of intersecting_features_attr_average for cells centers xs, ys."""
+        vlayer = self.project.mapLayer(vlayer_id)
+        spatial_index = self.get_spatial_index(vlayer)
+        cells = [self.cell_rectangle(x, y, only_center) for x, y in zip(xs.tolist(), ys.tolist())]
+        features = self.get_cached_features(vlayer, [attr_name])
+        return [self.features_attr_average(features, spatial_index.intersects(cell), cell, attr_name)
+                for cell in cells]
+
+    def interpolate_from_mesh_values(self, rows, cols, xs, ys, mesh_layer_id, group, dataset, above_existing):
+        """
+        Bulk version of interpolate_from_mesh for cells of rows, cols and centers xs, ys.
+        Values are interpolated from the cached mesh sampler for all the cells at once and existing raster values are
+        read in blocks of the cells within raster tiles.
+        """
+        mesh_layer = self.project.mapLayer(mesh_layer_id)
+        # mesh layer is not thread-safe, the mesh is loaded once and sampled without accessing the layer
+        with self.exp_lock:
+            sampler = self.mesh_cache.get_sampler(mesh_layer, group, dataset)
+        values = sampler.sample(xs, ys)
+        if above_existing and len(rows) > 0:
+            with self.exp_lock:
+                org_values = self.handler.read_cells(1, numpy.asarray(rows), numpy.asarray(cols))
+            keep = numpy.isnan(values) | nodata_mask(org_values, self.handler.nodata_values[0])
+            org_values = org_values.astype(float)
+            values = numpy.where(keep, values, numpy.maximum(org_values, values))
+        return values.tolist()
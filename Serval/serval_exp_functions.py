@@ -1,6 +1,8 @@
 from qgis.core import *
 from qgis.utils import plugins
 
+from .exp_evaluator import bulk_value
+
 
 @qgsfunction(args='auto', group='Serval', usesgeometry=True)
 def nearest_feature_attr_value(vlayer_id, attr_name, feature, parent):
@@ -32,6 +34,9 @@ def nearest_feature_attr_value(vlayer_id, attr_name, feature, parent):
             </li>
         </ul></div>
     """
+    found, value = bulk_value("nearest_feature_attr_value", (vlayer_id, attr_name), feature)
+    if found:
+        return value
     plugin = plugins["Serval"]
     return plugin.nearest_feature_attr_value(feature, vlayer_id, attr_name)
 
@@ -63,6 +68,9 @@ def nearest_pt_on_line_interpolate_z(vlayer_id, feature, parent):
             </li>
         </ul></div>
     """
+    found, value = bulk_value("nearest_pt_on_line_interpolate_z", (vlayer_id,), feature)
+    if found:
+        return value
     plugin = plugins["Serval"]
     return plugin.nearest_pt_on_line_interpolate_z(feature, vlayer_id)
 
@@ -98,6 +106,9 @@ def intersecting_features_attr_average(vlayer_id, attr_name, only_center, featur
             </li>
         </ul></div>
     """
+    found, value = bulk_value("intersecting_features_attr_average", (vlayer_id, attr_name, only_center), feature)
+    if found:
+        return value
     plugin = plugins["Serval"]
     return plugin.intersecting_features_attr_average(feature, vlayer_id, attr_name, only_center)
 
@@ -135,5 +146,8 @@ def interpolate_from_mesh(mlayer_id, group, dataset, above_existing, feature, pa
             </li>
         </ul></div>
     """
+    found, value = bulk_value("interpolate_from_mesh", (mlayer_id, group, dataset, above_existing), feature)
+    if found:
+        return value
     plugin = plugins["Serval"]
     return plugin.interpolate_from_mesh(feature, mlayer_id, group, dataset, above_existing)
@@ -0,0 +1,72 @@
+from qgis.PyQt.QtWidgets import (
+    QCheckBox,
+    QComboBox,
+    QDialog,
+    QDialogButtonBox,
+    QDoubleSpinBox,
+    QFormLayout,
+    QLineEdit,
+    QSpinBox,
+    QVBoxLayout,
+)
+
+
+class SettingsDialog(QDialog):
+    """Plugin settings dialog with an editor widget created for each setting definition."""
+
+    def __init__(self, default_settings, settings, parent=None):
+        super(QDialog, self).__init__(parent)
+        self.default_settings = default_settings
+        self.widgets = dict()
+        form = QFormLayout()
+        for key, definition in self.default_settings.items():
+            widget = self.create_widget(definition, settings[key])
+            self.widgets[key] = widget
+            form.addRow(definition.get("label", key), widget)
+        self.btns = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        self.btns.accepted.connect(self.accept)
+        self.btns.rejected.connect(self.reject)
+        lout = QVBoxLayout()
+        lout.addLayout(form)
+        lout.addWidget(self.btns)
+        self.setLayout(lout)
+        self.setWindowTitle("Serval Settings")
+
+    @staticmethod
+    def create_widget(definition, value):
+        vtype = definition["vtype"]
+        if "options" in definition:
+            widget = QComboBox()
+            widget.addItems(definition["options"])
+            widget.setCurrentText(value)
+        elif vtype == bool:
+            widget = QCheckBox()
+            widget.setChecked(value)
+        elif vtype == int:
+            widget = QSpinBox()
+            widget.setRange(definition.get("min", 0), definition.get("max", 999999))
+            widget.setValue(value)
+        elif vtype == float:
+            widget = QDoubleSpinBox()
+            widget.setRange(definition.get("min", 0.), definition.get("max", 999999.))
+            widget.setValue(value)
+        else:
+            widget = QLineEdit()
+            widget.setText(value)
+        if "tooltip" in definition:
+            widget.setToolTip(definition["tooltip"])
+        return widget
+
+    def get_values(self):
+        """Return dict of current values of settings editors."""
+        values = dict()
+        for key, widget in self.widgets.items():
+            if isinstance(widget, QComboBox):
+                values[key] = widget.currentText()
+            elif isinstance(widget, QCheckBox):
+                values[key] = widget.isChecked()
+            elif isinstance(widget, (QSpinBox, QDoubleSpinBox)):
+                values[key] = widget.value()
+            else:
+                values[key] = widget.text()
+        return values
@@ -1,7 +1,11 @@
+import math
 import os
-from osgeo import gdal
+import numpy
+from osgeo import gdal, ogr
 import tempfile
 
+from qgis.core import QgsRasterBlock
+
 dtypes = {
     0: {'name': 'UnknownDataType'}, 
     1: {'name': 'Byte', 'atype': 'B',
@@ -59,38 +63,49 @@ def get_logger():
     return logger
 
 
-def low_pass_filtered(block, row, col, nodata_value, nodata_mode=False):
+def nodata_mask(array, nodata_value):
+    """Return boolean array marking cells of the array having nodata value."""
+    if nodata_value is None:
+        return numpy.zeros(array.shape, dtype=bool)
+    if isinstance(nodata_value, float) and math.isnan(nodata_value):
+        return numpy.isnan(array)
+    return array == nodata_value
+
+
+def block_to_array(block):
+    """Return a copy of raster block data as 2D NumPy array of the block data type."""
+    dtype = numpy.dtype(dtypes[block.dataType()]['atype'])
+    array = numpy.frombuffer(block.data().data(), dtype=dtype)
+    return array.reshape(block.height(), block.width()).copy()
+
+
+def array_to_block(array, data_type):
+    """Return a new raster block of the data type filled with the 2D array values."""
+    rows, cols = array.shape
+    block = QgsRasterBlock(data_type, cols, rows)
+    block.setData(array.astype(dtypes[data_type]['atype']).tobytes())
+    return block
+
+
+def line_cells(row_0, col_0, row_1, col_1):
+    """Return arrays of rows and columns of cells on the line between two cells, including both of them."""
+    steps = max(abs(row_1 - row_0), abs(col_1 - col_0))
+    t = numpy.linspace(0., 1., steps + 1)
+    rows = numpy.rint(row_0 + (row_1 - row_0) * t).astype(numpy.int64)
+    cols = numpy.rint(col_0 + (col_1 - col_0) * t).astype(numpy.int64)
+    return rows, cols
+
+
+def brush_rows(radius_rows, radius_cols):
     """
-    Return low-pass filtered (3x3) value of raster cell from the block at (row, col).
-    Cells at the edge of block are not filtered.
-    Cells having originally nodata are not modified either.
-    If nodata_mode is True, the nodata value will be return if any neighbor has nodata value. Otherwise, neighboring
-    nodata cells are ignored.
+    Return arrays of row offsets from the center cell and half widths (in cells) of the rows of the brush ellipse of
+    the radii (in cells). The center cell alone is returned for zero radius.
     """
-    org_val = block.value(row, col)
-    if org_val == nodata_value:
-        return nodata_value
-    max_row = block.height() - 1
-    max_col = block.width() - 1
-    if row == 0 or row == max_row or col == 0 or col == max_col:
-        # the cell is at the edge of block - return the original value
-        return org_val
-    vals = []
-    for r in (row - 1, row, row + 1):
-        for c in (col - 1, col, col + 1):
-            val = block.value(r, c)
-            if val == nodata_value:
-                if nodata_mode:
-                    # return nodata if any neighbor has nodata value
-                    return nodata_value
-                else:
-                    continue
-            vals.append(val)
-    if len(vals) == 0:
-        new_val = nodata_value
-    else:
-        new_val = sum(vals) / len(vals)
-    return new_val
+    max_row = int(radius_rows)
+    d_rows = numpy.arange(-max_row, max_row + 1)
+    share = numpy.clip(1. - (d_rows / max(radius_rows, 1e-9)) ** 2, 0., 1.)
+    half_widths = numpy.floor(radius_cols * numpy.sqrt(share) + 1e-9).astype(numpy.int64)
+    return d_rows, half_widths
 
 
 def check_gdal_driver_create_option(layer):
@@ -106,3 +121,22 @@ def check_gdal_driver_create_option(layer):
         return test_dataset is not None
     except (AttributeError, RuntimeError):
         return False
+
+
+def rasterize_geometries(geometries, x_min, y_max, pixel_size_x, pixel_size_y, rows, cols, all_touched=True):
+    """
+    Burn the geometries into a boolean mask of rows x cols cells with upper left corner at (x_min, y_max).
+    If all_touched is True, every cell touched by a geometry is burnt. Otherwise, only cells with center inside
+    a geometry are burnt.
+    """
+    mask_ds = gdal.GetDriverByName("MEM").Create("", cols, rows, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform((x_min, pixel_size_x, 0., y_max, 0., -pixel_size_y))
+    ogr_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+    ogr_layer = ogr_ds.CreateLayer("selection")
+    for geom in geometries:
+        feat = ogr.Feature(ogr_layer.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkb(bytes(geom.asWkb())))
+        ogr_layer.CreateFeature(feat)
+    options = ["ALL_TOUCHED=TRUE"] if all_touched else []
+    gdal.RasterizeLayer(mask_ds, [1], ogr_layer, burn_values=[1], options=options)
+    return mask_ds.GetRasterBand(1).ReadAsArray().astype(bool)